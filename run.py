@@ -1,27 +1,84 @@
+import argparse
 import asyncio
 import shutil
+import time
 
-from src.core import logger
-from src.web import Bilibili, Tangxin, Telegram
+_start = time.perf_counter()
+
+from src.core import config, logger  # noqa: E402
+from src.core.admission import admission  # noqa: E402
+from src.core.lag import LagMonitor  # noqa: E402
+from src.tool import cloudflare, notifier  # noqa: E402
+from src.web import SOURCES, import_times, load  # noqa: E402
 
 log = logger.get('main')
 
-# verify ffmpeg is available
-if not shutil.which('ffmpeg'):
-    log.error('ffmpeg command not found in PATH. Please install ffmpeg.')
-    raise SystemExit(1)
 
-# verify yt-dlp is available
-if not shutil.which('yt-dlp'):
-    log.error('yt-dlp command not found in PATH. Please install yt-dlp.')
-    raise SystemExit(1)
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Download favourites from the configured sources.')
+    parser.add_argument('sources', nargs='*', metavar='SOURCE', help=f'sources to run ({", ".join(SOURCES)}), default all')
+    parser.add_argument('--fav-id', type=int, action='append', dest='fav_ids', help='bilibili favorite list id, -1 for toview (repeatable)')
+    parser.add_argument('--channel', type=int, action='append', dest='channels', help='telegram channel id (repeatable)')
+    parser.add_argument('--reconcile', action='store_true', help='compare D1 records with the libraries and print fix-up actions')
+    parser.add_argument('--apply', action='store_true', help='with --reconcile, apply the fix-up actions')
+    args = parser.parse_args()
+    if unknown := [s for s in args.sources if s not in SOURCES]:
+        parser.error(f'unknown source: {", ".join(unknown)}')
+    return args
+
+
+def check_commands(sources: list[str]) -> None:
+    commands = {c for name in sources for c in SOURCES[name].commands}
+    if config.faststart:
+        commands.add('ffmpeg')
+    for command in sorted(commands):
+        if not shutil.which(command):
+            log.error('%s command not found in PATH. Please install %s.', command, command)
+            raise SystemExit(1)
+
+
+async def reconcile(sources: list[str], *, apply: bool) -> None:
+    from src.tool.reconcile import Reconciler, dumps  # noqa: PLC0415
+
+    actions = await Reconciler().run(sources)
+    for action in actions:
+        print(dumps(action))  # noqa: T201
+    if apply:
+        await Reconciler.apply(actions)
 
 
-async def main() -> None:
-    await Tangxin().update()
-    await Bilibili().update()
-    await Telegram().update()
+async def main(args: argparse.Namespace) -> None:
+    sources = args.sources or list(SOURCES)
+    if args.reconcile:
+        try:
+            await reconcile(sources, apply=args.apply)
+        finally:
+            await cloudflare.aclose()
+        return
+    check_commands(sources)
+    classes = {name: load(name) for name in sources}
+    log.info(
+        'Startup took %.0f ms (%s)',
+        (time.perf_counter() - _start) * 1000,
+        ', '.join(f'{name} {import_times[name] * 1000:.0f} ms' for name in sources),
+    )
+    lag = LagMonitor()
+    lag.start()
+    try:
+        for name, cls in classes.items():
+            if name == 'bilibili':
+                await cls().update(fav_ids=args.fav_ids)
+            elif name == 'telegram':
+                await cls().update(channels=args.channels)
+            else:
+                await cls().update()
+    finally:
+        # one batched notification per run instead of a full library scan
+        await notifier.flush()
+        await cloudflare.aclose()
+        await lag.stop()
+        await admission.log_status()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,100 @@
+# ruff: noqa: INP001
+"""Simulate fixed vs adaptive segment concurrency against two fake origins.
+
+- fast: a 40 MB/s link where each connection is capped at 1 MB/s, so more connections help
+- throttled: a 3 MB/s link that degrades past 6 connections and times out past 12
+
+Each scenario downloads the same segments once with a fixed limit and once with
+`AdaptiveConcurrency`, and prints the wall time and the limit the controller settled at.
+
+Run from the repository root:
+
+    python -m script.concurrency_sim
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from src.core.concurrency import AdaptiveConcurrency, Sample
+
+TICK = 0.02
+RETRY_DELAY = 0.5
+
+
+class Origin:
+    def __init__(self, link: float, per_conn: float, latency: float, max_conn: int | None = None) -> None:
+        """A server with a shared link, a per-connection cap and an optional connection limit.
+
+        Past `max_conn` connections everyone slows down quadratically, past twice that
+        new requests time out.
+        """
+        self.link = link
+        self.per_conn = per_conn
+        self.latency = latency
+        self.max_conn = max_conn
+        self.active = 0
+
+    def rate(self) -> float:
+        rate = min(self.per_conn, self.link / self.active)
+        if self.max_conn and self.active > self.max_conn:
+            rate *= (self.max_conn / self.active) ** 2
+        return rate
+
+    async def fetch(self, size: int, sample: Sample) -> None:
+        if self.max_conn and self.active >= 2 * self.max_conn:
+            await asyncio.sleep(3)
+            raise TimeoutError
+        self.active += 1
+        try:
+            await asyncio.sleep(self.latency)
+            left = size
+            while left > 0:
+                n = min(left, int(self.rate() * TICK))
+                await asyncio.sleep(TICK)
+                left -= n
+                sample.add(n)
+        finally:
+            self.active -= 1
+
+
+async def run(origin: Origin, segments: int, size: int, fixed: int | None, state: Path) -> tuple[float, float]:
+    concurrency = AdaptiveConcurrency(initial=fixed or 4, min_limit=fixed or 1, max_limit=fixed or 64, path=state)
+
+    async def fetch_segment() -> None:
+        while True:
+            try:
+                async with concurrency.slot('origin') as sample:
+                    await origin.fetch(size, sample)
+            except TimeoutError:
+                await asyncio.sleep(RETRY_DELAY)
+            else:
+                return
+
+    start = time.monotonic()
+    await asyncio.gather(*[fetch_segment() for _ in range(segments)])
+    return time.monotonic() - start, concurrency.get('origin').limit
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixed', type=int, default=10, help='limit of the fixed run')
+    parser.add_argument('--size', type=int, default=100_000, help='segment size in bytes')
+    args = parser.parse_args()
+
+    scenarios = {
+        'fast': (lambda: Origin(40e6, 1e6, 0.2), 600),
+        'throttled': (lambda: Origin(3e6, 1e6, 0.2, max_conn=6), 150),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        # a fresh state file per run, so learned limits do not leak between runs
+        for name, (origin, segments) in scenarios.items():
+            fixed, _ = asyncio.run(run(origin(), segments, args.size, args.fixed, Path(tmp, f'{name}-fixed.json')))
+            adaptive, limit = asyncio.run(run(origin(), segments, args.size, None, Path(tmp, f'{name}-adaptive.json')))
+            print(f'{name}: fixed {args.fixed} {fixed:.2f}s, adaptive {adaptive:.2f}s (limit settled at {limit:.1f})')  # noqa: T201
+
+
+if __name__ == '__main__':
+    main()
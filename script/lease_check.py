@@ -0,0 +1,85 @@
+# ruff: noqa: INP001
+"""Check D1 lease claiming with two workers against a fake, in-process D1.
+
+The fake runs the real lease SQL on SQLite (3.35+ for RETURNING, 3.38+ for unixepoch) with a
+small per-query latency, and both workers list and claim from the same backlog at once.
+It checks that no item is downloaded twice and compares throughput with a single worker.
+
+Run from the repository root:
+
+    python -m script.lease_check
+"""
+
+import argparse
+import asyncio
+import collections
+import sqlite3
+import time
+from typing import Any
+
+from src.core import config
+from src.core.config import Worker
+from src.tool import cloudflare
+from src.tool.lease import Leases
+
+QUERY_LATENCY = 0.005
+
+
+class FakeD1:
+    def __init__(self) -> None:
+        self.db = sqlite3.connect(':memory:', isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+
+    async def query_d1(self, query: str, params: tuple[str, ...] = (), **_: Any) -> list[dict[str, Any]]:
+        await asyncio.sleep(QUERY_LATENCY)
+        return [dict(row) for row in self.db.execute(query, params).fetchall()]
+
+
+async def worker(name: str, d1: FakeD1, downloads: collections.Counter, download_time: float) -> None:
+    leases = Leases('tangxin', table='tx', pending='downloaded = 0')
+    leases.worker_id = name
+    try:
+        rows = await d1.query_d1(f'SELECT id FROM tx WHERE downloaded = 0 AND {leases.available()} ORDER BY id;')  # noqa: S608
+        for row in rows:
+            if not await leases.claim(row['id']):
+                continue
+            try:
+                await asyncio.sleep(download_time)
+                downloads[row['id']] += 1
+                await d1.query_d1('UPDATE tx SET downloaded = 1 WHERE id = ?;', (str(row['id']),))
+            finally:
+                await leases.release(row['id'])
+    finally:
+        await leases.close()
+
+
+async def run(workers: int, items: int, download_time: float) -> tuple[float, collections.Counter]:
+    d1 = FakeD1()
+    cloudflare.query_d1 = d1.query_d1
+    d1.db.execute('CREATE TABLE tx (id INTEGER PRIMARY KEY, downloaded INTEGER DEFAULT 0);')
+    d1.db.executemany('INSERT INTO tx (id) VALUES (?);', [(i,) for i in range(items)])
+    await Leases('tangxin', table='tx', pending='downloaded = 0').init()
+    downloads: collections.Counter = collections.Counter()
+    start = time.monotonic()
+    await asyncio.gather(*[worker(f'worker-{i}', d1, downloads, download_time) for i in range(workers)])
+    return time.monotonic() - start, downloads
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--download-time', type=float, default=0.05)
+    args = parser.parse_args()
+    config.worker = Worker(enabled=True, lease_ttl=60)
+
+    single, _ = asyncio.run(run(1, args.items, args.download_time))
+    double, downloads = asyncio.run(run(2, args.items, args.download_time))
+    twice = [key for key, n in downloads.items() if n > 1]
+    print(f'1 worker: {single:.2f}s, 2 workers: {double:.2f}s, speedup {single / double:.2f}x')  # noqa: T201
+    print(f'{len(downloads)}/{args.items} items downloaded, {len(twice)} more than once')  # noqa: T201
+    if twice or len(downloads) != args.items:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,5 @@
 from .config import config as config
 from . import logger as logger
+from . import progress as progress
+from . import trace as trace
+from . import fs as fs
@@ -0,0 +1,125 @@
+"""Disk-space admission control.
+
+Before an item is scheduled, its pipeline reserves the scratch and library space it is
+expected to need. Reservations are accounted per filesystem, and an item is held until
+the free space minus what is already reserved can fit it.
+"""
+
+import asyncio
+import shutil
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from . import fs, logger
+
+log = logger.get('admission')
+
+# keep some headroom for logs, journals and estimation errors
+DEFAULT_MARGIN = 1024**3
+
+
+class InsufficientSpaceError(RuntimeError):
+    """Raised when an item cannot fit even with no other reservations."""
+
+
+def _device(path: Path) -> tuple[int, Path]:
+    """Return the device id and the nearest existing ancestor of `path`."""
+    path = path.resolve()
+    while not path.exists():
+        path = path.parent
+    return path.stat().st_dev, path
+
+
+@dataclass
+class Reservation:
+    controller: 'DiskAdmission'
+    desc: str
+    sizes: dict[int, int] = field(default_factory=dict)
+    released: bool = False
+
+    async def release(self) -> None:
+        if not self.released:
+            self.released = True
+            await self.controller._release(self)  # noqa: SLF001
+
+
+class DiskAdmission:
+    """Reserve disk space per filesystem before scheduling downloads."""
+
+    def __init__(self, margin: int = DEFAULT_MARGIN) -> None:
+        self.margin = margin
+        self._reserved: dict[int, int] = {}
+        # free space before the active reservations started writing, per filesystem
+        self._base: dict[int, int] = {}
+        self._paths: dict[int, Path] = {}
+        self._cond = asyncio.Condition()
+
+    async def _free(self, dev: int) -> int:
+        return (await fs.run(shutil.disk_usage, self._paths[dev])).free
+
+    def _available(self, dev: int, free: int) -> int:
+        """Space that can still be reserved on a filesystem with `free` bytes free.
+
+        Bytes that in-flight items have written are gone from the live free space but still
+        part of their reservations, so the reservations are taken off the baseline instead.
+        """
+        if not self._reserved.get(dev):
+            return free - self.margin
+        return min(self._base[dev] - self._reserved[dev], free) - self.margin
+
+    async def reserve(self, needs: dict[Path, int], desc: str) -> Reservation:
+        """Reserve `needs` (path -> bytes), waiting until every filesystem involved has room."""
+        sizes: dict[int, int] = {}
+        for path, size in needs.items():
+            dev, existing = await fs.run(_device, path)
+            self._paths.setdefault(dev, existing)
+            sizes[dev] = sizes.get(dev, 0) + size
+        waiting = False
+        while True:
+            # polled outside the lock, a slow disk must not hold up releases
+            free = {dev: await self._free(dev) for dev in sizes}
+            async with self._cond:
+                short = {dev: size for dev, size in sizes.items() if size > self._available(dev, free[dev])}
+                if not short:
+                    for dev, size in sizes.items():
+                        if not self._reserved.get(dev):
+                            self._base[dev] = free[dev]
+                        self._reserved[dev] = self._reserved.get(dev, 0) + size
+                    break
+                if all(not self._reserved.get(dev) for dev in short):
+                    dev, size = next(iter(short.items()))
+                    available = self._available(dev, free[dev])
+                    msg = f'Not enough space for {desc}: needs {size >> 20} MiB on {self._paths[dev]}, {available >> 20} MiB free'
+                    raise InsufficientSpaceError(msg)
+                if waiting:
+                    await self._cond.wait()
+                    continue
+            log.info('Holding %s until there is room on %s', desc, ', '.join(str(self._paths[d]) for d in short))
+            await self.log_status()
+            waiting = True
+        log.debug('Reserved %s for %s', {str(self._paths[d]): s >> 20 for d, s in sizes.items()}, desc)
+        return Reservation(self, desc, sizes)
+
+    async def _release(self, reservation: Reservation) -> None:
+        free = {dev: await self._free(dev) for dev in reservation.sizes}
+        async with self._cond:
+            for dev, size in reservation.sizes.items():
+                self._reserved[dev] -= size
+                if not self._reserved[dev]:
+                    self._base.pop(dev, None)
+                else:
+                    # assume the released item's bytes stayed, but the baseline is never below the live free space
+                    self._base[dev] = max(self._base[dev] - size, free[dev])
+            self._cond.notify_all()
+
+    async def status(self) -> dict[str, tuple[int, int]]:
+        """Return (reserved, free) bytes per known filesystem, keyed by a path on it."""
+        return {str(path): (self._reserved.get(dev, 0), await self._free(dev)) for dev, path in self._paths.items()}
+
+    async def log_status(self) -> None:
+        """Log reserved versus free space of every filesystem seen so far."""
+        for path, (reserved, free) in (await self.status()).items():
+            log.info('%s: %d MiB reserved, %d MiB free', path, reserved >> 20, free >> 20)
+
+
+admission = DiskAdmission()
@@ -0,0 +1,154 @@
+"""Adaptive per-host request concurrency.
+
+Each host gets an AIMD controller, like TCP congestion control: after every window of
+completed requests the limit grows by one while goodput keeps improving and latency is
+not inflating, backs off gently when latency rises without a goodput gain, and is cut to
+70% when requests fail. Learned limits are kept in `./data/concurrency.json`, so the next run
+starts where the last one settled.
+"""
+
+import asyncio
+import contextlib
+import json
+import math
+import time
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+from . import logger
+
+log = logger.get('concurrency')
+
+STATE_PATH = Path('./data/concurrency.json')
+# a window must improve goodput by this much to count as a gain
+GAIN_THRESHOLD = 1.05
+# latency over this multiple of the best seen counts as queueing
+LATENCY_THRESHOLD = 1.5
+DECREASE_FACTOR = 0.7
+MIN_WINDOW = 4
+
+
+class Sample:
+    """Bytes transferred by one request, filled in by the caller."""
+
+    __slots__ = ('bytes', 'epoch')
+
+    def __init__(self, epoch: int) -> None:
+        self.bytes = 0
+        self.epoch = epoch
+
+    def add(self, n: int) -> None:
+        self.bytes += n
+
+
+class HostController:
+    """AIMD limit on the concurrent requests to one host."""
+
+    def __init__(self, host: str, limit: float, min_limit: int, max_limit: int) -> None:
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min(max(limit, min_limit), max_limit)
+        self.inflight = 0
+        self._cond = asyncio.Condition()
+        self._goodput = 0.0
+        self._min_latency = math.inf
+        # bumped on every decrease, so requests started before it cannot trigger another one
+        self._epoch = 0
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        self._window_start = time.monotonic()
+        self._bytes = 0
+        self._count = 0
+        self._errors = 0
+        self._latency = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, *, wait: bool = True) -> AsyncIterator[Sample]:
+        """Wait for a free slot and account the request made in it.
+
+        With `wait=False` the request is admitted even above the limit, for hedges that must
+        not queue behind the request they are meant to overtake. Exceptions count as errors,
+        cancellation (e.g. a losing hedge) does not.
+        """
+        async with self._cond:
+            if wait:
+                await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+        sample = Sample(self._epoch)
+        start = time.monotonic()
+        try:
+            yield sample
+        except Exception:
+            self._record(sample, time.monotonic() - start, ok=False)
+            raise
+        else:
+            self._record(sample, time.monotonic() - start, ok=True)
+        finally:
+            async with self._cond:
+                self.inflight -= 1
+                self._cond.notify_all()
+
+    def _record(self, sample: Sample, latency: float, *, ok: bool) -> None:
+        self._bytes += sample.bytes
+        self._count += 1
+        if ok:
+            self._latency += latency
+            self._min_latency = min(self._min_latency, latency)
+        elif sample.epoch == self._epoch:
+            self._errors += 1
+        if self._count >= max(int(self.limit), MIN_WINDOW):
+            self._adjust()
+
+    def _adjust(self) -> None:
+        elapsed = max(time.monotonic() - self._window_start, 1e-3)
+        goodput = self._bytes / elapsed
+        ok = self._count - self._errors
+        latency = self._latency / ok if ok else math.inf
+        old = self.limit
+        if self._errors:
+            self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+            self._epoch += 1
+        elif goodput < self._goodput * GAIN_THRESHOLD and latency > self._min_latency * LATENCY_THRESHOLD:
+            # more requests only queue up somewhere, step back towards the knee
+            self.limit = max(self.min_limit, self.limit - 1)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        # smoothed, single windows are too noisy to compare against
+        self._goodput = goodput if not self._goodput else (self._goodput + goodput) / 2
+        if int(old) != int(self.limit):
+            log.debug(
+                '%s: limit %d -> %d (%.1f MB/s, %.2fs latency, %d/%d errors)',
+                self.host, old, self.limit, goodput / 1024**2, latency, self._errors, self._count,
+            )
+        self._reset_window()
+
+
+class AdaptiveConcurrency:
+    """Per-host controllers with limits persisted between runs."""
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 64, path: Path = STATE_PATH) -> None:
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.path = path
+        self.learned: dict[str, float] = json.loads(path.read_text()) if path.exists() else {}
+        self.hosts: dict[str, HostController] = {}
+
+    def get(self, host: str) -> HostController:
+        if host not in self.hosts:
+            self.hosts[host] = HostController(host, self.learned.get(host, self.initial), self.min_limit, self.max_limit)
+        return self.hosts[host]
+
+    def slot(self, host: str, *, wait: bool = True) -> contextlib.AbstractAsyncContextManager[Sample]:
+        return self.get(host).slot(wait=wait)
+
+    def save(self) -> None:
+        self.learned.update({host: round(c.limit, 2) for host, c in self.hosts.items()})
+        for host, c in self.hosts.items():
+            log.info('Concurrency for %s settled at %d', host, c.limit)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.learned, indent=2))
+        tmp_path.replace(self.path)
@@ -1,21 +1,53 @@
+import tomllib
 from pathlib import Path
 from typing import Any
 
-from pydantic import BaseModel
-from pydantic_settings import BaseSettings, PydanticBaseSettingsSource, SettingsConfigDict, TomlConfigSettingsSource
+from pydantic import BaseModel, TypeAdapter, model_validator
 
 from . import logger
 
+CONFIG_PATH = Path('./data/config.toml')
 
-class Bilibili(BaseModel):
+
+class CookieCloud(BaseModel):
+    server_url: str
+    uuid: str
+    password: str
+
+
+class BilibiliAccount(BaseModel):
     id: int
-    fav_id: int
+    folders: list[int] = []
+    toview: bool = True
+    # defaults to the top-level [cookiecloud] section
+    cookiecloud: CookieCloud | None = None
+    # API requests per second
+    rate: float = 2.0
+
+
+class Bilibili(BaseModel):
     path: Path
+    id: int | None = None
+    fav_id: int | None = None
+    accounts: list[BilibiliAccount] = []
+    # concurrent downloads taken from the job queue
+    workers: int = 1
+
+    @model_validator(mode='after')
+    def _legacy_account(self) -> 'Bilibili':
+        # the single `id`/`fav_id` form is kept as shorthand for one account
+        if self.id is not None and not any(a.id == self.id for a in self.accounts):
+            self.accounts.append(BilibiliAccount(id=self.id, folders=[self.fav_id] if self.fav_id is not None else []))
+        return self
 
 
 class Tx(BaseModel):
     path: Path
     host: str
+    workers: int = 1
+    # concurrent segment requests per host, adapted at runtime within these bounds
+    segment_concurrency: int = 4
+    max_segment_concurrency: int = 64
 
 
 class Cloudflare(BaseModel):
@@ -23,12 +55,11 @@ class Cloudflare(BaseModel):
     api_key: str
     d1_id: str
     kv_id: dict[str, str]
-
-
-class CookieCloud(BaseModel):
-    server_url: str
-    uuid: str
-    password: str
+    timeout: float = 30
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    http2: bool = False
+    retries: int = 5
 
 
 class Telegram(BaseModel):
@@ -37,23 +68,83 @@ class Telegram(BaseModel):
     api_hash: str
     path: Path
     session_path: Path
+    workers: int = 1
+
+
+class Trace(BaseModel):
+    enabled: bool = False
+    sample_rate: float = 1.0
+    path: Path = Path('./data/trace')
+
+
+class Worker(BaseModel):
+    # claim items through D1 leases so several machines can share the backlog
+    enabled: bool = False
+    # defaults to <hostname>-<pid>
+    id: str | None = None
+    lease_ttl: int = 600
+
+
+class MediaServer(BaseModel):
+    # Emby/Jellyfin base URL, no notification when unset
+    url: str | None = None
+    api_key: str = ''
+    timeout: float = 30
+    # write .nfo sidecars next to new files
+    nfo: bool = False
+    # local path prefix -> path prefix as seen by the server
+    path_map: dict[str, str] = {}
 
 
-class Config(BaseSettings):
+class Config(BaseModel):
     proxy: str
+    faststart: bool = False
+    # threads for blocking filesystem calls, see src/core/fs.py
+    fs_threads: int = 8
+    trace: Trace = Trace()
+    worker: Worker = Worker()
+    mediaserver: MediaServer = MediaServer()
     bilibili: Bilibili
     tx: Tx
     cloudflare: Cloudflare
     cookiecloud: CookieCloud
     telegram: Telegram
 
-    model_config = SettingsConfigDict(toml_file='./data/config.toml')
 
-    @classmethod
-    def settings_customise_sources(cls, settings_cls: type[BaseSettings], *_: Any, **__: Any) -> tuple[PydanticBaseSettingsSource, ...]:
-        return (TomlConfigSettingsSource(settings_cls),)
+class LazyConfig:
+    """Read the TOML file once and validate each section on first access.
+
+    A run that only needs Telegram neither pays for nor fails on the other sections.
+    """
+
+    def __init__(self, path: Path = CONFIG_PATH) -> None:
+        self._path = path
+        self._raw: dict[str, Any] | None = None
+
+    def _load(self) -> dict[str, Any]:
+        if self._raw is None:
+            with self._path.open('rb') as f:
+                self._raw = tomllib.load(f)
+        return self._raw
+
+    def __getattr__(self, name: str) -> Any:
+        field = Config.model_fields.get(name)
+        if name.startswith('_') or field is None:
+            raise AttributeError(name)
+        raw = self._load()
+        if name in raw:
+            value = TypeAdapter(field.annotation).validate_python(raw[name])
+        elif field.is_required():
+            msg = f'Missing config section [{name}] in {self._path}'
+            raise ValueError(msg)
+        else:
+            value = field.get_default(call_default_factory=True)
+        log.debug('Validated config section %s', name)
+        # cache on the instance so later lookups skip __getattr__
+        setattr(self, name, value)
+        return value
 
 
 log = logger.get('config')
 
-config = Config()
+config: Config = LazyConfig()  # type: ignore[assignment]
@@ -0,0 +1,89 @@
+"""Non-blocking filesystem calls for the download pipelines.
+
+Calls that can block for a long time on a slow NAS, such as mkdir, rmtree or a
+cross-device move, run on a dedicated, size-limited thread pool. A slow disk then only
+stalls that pool, not the event loop with its Telethon keepalives and httpx streams. The
+pool is separate from the default executor, so `asyncio.to_thread` work (yt-dlp, faststart
+checks) and filesystem calls do not starve each other.
+"""
+
+import asyncio
+import functools
+import shutil
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from .config import config
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=config.fs_threads, thread_name_prefix='fs')
+    return _executor
+
+
+async def run[T](func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking filesystem function on the filesystem pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def exists(path: Path) -> bool:
+    return await run(path.exists)
+
+
+async def is_file(path: Path) -> bool:
+    return await run(path.is_file)
+
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+async def size(path: Path) -> int:
+    """Size of a file in bytes, 0 if it does not exist."""
+    return await run(_size, path)
+
+
+async def mkdir(path: Path, *, parents: bool = True, exist_ok: bool = True) -> None:
+    await run(path.mkdir, parents=parents, exist_ok=exist_ok)
+
+
+async def iterdir(path: Path) -> list[Path]:
+    return await run(lambda: list(path.iterdir()))
+
+
+async def read_text(path: Path) -> str:
+    return await run(path.read_text)
+
+
+async def write_text(path: Path, text: str) -> None:
+    await run(path.write_text, text)
+
+
+async def write_bytes(path: Path, data: bytes) -> None:
+    await run(path.write_bytes, data)
+
+
+async def unlink(path: Path, *, missing_ok: bool = False) -> None:
+    await run(path.unlink, missing_ok=missing_ok)
+
+
+async def move(src: Path, dst: Path) -> None:
+    await run(shutil.move, src, dst)
+
+
+async def replace(src: Path, dst: Path) -> None:
+    await run(src.replace, dst)
+
+
+async def rmtree(path: Path, *, ignore_errors: bool = False) -> None:
+    await run(shutil.rmtree, path, ignore_errors=ignore_errors)
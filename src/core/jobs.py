@@ -0,0 +1,216 @@
+"""Durable local job queue decoupling discovery from downloading.
+
+Discovery puts jobs into an SQLite database under `./data`, and per-source worker pools
+take them out. A job moves through discovered -> fetching -> merging -> committing -> done,
+or back to discovered with a retry-after time when it fails, until it runs out of attempts.
+Dequeue is a single indexed UPDATE ... RETURNING, so it stays cheap with tens of thousands
+of queued jobs.
+"""
+
+import asyncio
+import json
+import sqlite3
+import time
+from collections.abc import Awaitable, Callable, Collection, Mapping
+from dataclasses import dataclass
+from enum import StrEnum
+from pathlib import Path
+from typing import Any
+
+from . import logger
+
+log = logger.get('jobs')
+
+QUEUE_PATH = Path('./data/jobs.db')
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60.0
+
+
+class State(StrEnum):
+    DISCOVERED = 'discovered'
+    FETCHING = 'fetching'
+    MERGING = 'merging'
+    COMMITTING = 'committing'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+ACTIVE = (State.FETCHING, State.MERGING, State.COMMITTING)
+
+
+@dataclass
+class Job:
+    id: int
+    source: str
+    key: str
+    state: State
+    priority: int
+    payload: dict[str, Any]
+    attempts: int
+    retry_after: float
+    error: str | None
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> 'Job':
+        return cls(
+            id=row['id'],
+            source=row['source'],
+            key=row['key'],
+            state=State(row['state']),
+            priority=row['priority'],
+            payload=json.loads(row['payload']),
+            attempts=row['attempts'],
+            retry_after=row['retry_after'],
+            error=row['error'],
+        )
+
+
+class JobQueue:
+    def __init__(self, path: Path = QUEUE_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode = WAL;')
+        self.db.execute('PRAGMA synchronous = NORMAL;')
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                retry_after REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                UNIQUE (source, key)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (source, state, priority DESC, id);
+        """)
+
+    def put_many(self, source: str, jobs: list[tuple[str | int, dict[str, Any], int]]) -> None:
+        """Add (key, payload, priority) jobs, re-queueing finished ones that were discovered again."""
+        now = time.time()
+        with self.db:
+            self.db.execute('BEGIN;')
+            self.db.executemany(
+                """
+                INSERT INTO jobs (source, key, state, priority, payload, updated_at) VALUES (?, ?, 'discovered', ?, ?, ?)
+                ON CONFLICT (source, key) DO UPDATE SET
+                    payload = excluded.payload,
+                    priority = excluded.priority,
+                    state = CASE WHEN jobs.state IN ('done', 'failed') THEN 'discovered' ELSE jobs.state END,
+                    attempts = CASE WHEN jobs.state IN ('done', 'failed') THEN 0 ELSE jobs.attempts END,
+                    retry_after = CASE WHEN jobs.state IN ('done', 'failed') THEN 0 ELSE jobs.retry_after END,
+                    updated_at = excluded.updated_at;
+                """,
+                [(source, str(key), priority, json.dumps(payload, ensure_ascii=False), now) for key, payload, priority in jobs],
+            )
+
+    def put(self, source: str, key: str | int, payload: dict[str, Any], priority: int = 0) -> None:
+        self.put_many(source, [(key, payload, priority)])
+
+    def get(self, source: str, only: Mapping[str, Collection[Any]] | None = None) -> Job | None:
+        """Take the highest-priority ready job of a source and mark it as fetching.
+
+        `only` restricts it to jobs whose payload fields have one of the given values,
+        e.g. `{'channel_id': [123]}`.
+        """
+        now = time.time()
+        where, params = '', []
+        for field, values in (only or {}).items():
+            where += f" AND json_extract(payload, ?) IN ({', '.join('?' * len(values))})"
+            params += [f'$.{field}', *values]
+        row = self.db.execute(
+            f"""
+            UPDATE jobs SET state = 'fetching', attempts = attempts + 1, updated_at = ?
+            WHERE id = (
+                SELECT id FROM jobs WHERE source = ? AND state = 'discovered' AND retry_after <= ?{where}
+                ORDER BY priority DESC, id LIMIT 1
+            )
+            RETURNING *;
+            """,  # noqa: S608
+            (now, source, now, *params),
+        ).fetchone()
+        return Job.from_row(row) if row else None
+
+    def set_state(self, job: Job, state: State) -> None:
+        job.state = state
+        self.db.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?;', (state.value, time.time(), job.id))
+
+    def done(self, job: Job) -> None:
+        self.set_state(job, State.DONE)
+
+    def fail(self, job: Job, error: str, max_attempts: int = MAX_ATTEMPTS, delay: float = RETRY_DELAY) -> None:
+        """Schedule a retry with exponential backoff, or give up after `max_attempts`."""
+        if job.attempts < max_attempts:
+            job.state = State.DISCOVERED
+            retry_after = time.time() + delay * 2 ** (job.attempts - 1)
+        else:
+            job.state = State.FAILED
+            retry_after = 0
+        log.warning('Job %s %s failed (%d/%d): %s', job.source, job.key, job.attempts, max_attempts, error)
+        self.db.execute(
+            'UPDATE jobs SET state = ?, retry_after = ?, error = ?, updated_at = ? WHERE id = ?;',
+            (job.state.value, retry_after, error, time.time(), job.id),
+        )
+
+    def drop(self, job: Job) -> None:
+        """Forget a job that no longer needs doing, e.g. taken by another worker."""
+        self.db.execute('DELETE FROM jobs WHERE id = ?;', (job.id,))
+
+    def recover(self, source: str) -> int:
+        """Put jobs left in an active state by a crashed run back in the queue."""
+        placeholders = ', '.join('?' * len(ACTIVE))
+        cur = self.db.execute(
+            f"UPDATE jobs SET state = 'discovered', updated_at = ? WHERE source = ? AND state IN ({placeholders});",  # noqa: S608
+            (time.time(), source, *ACTIVE),
+        )
+        if cur.rowcount:
+            log.info('Recovered %d interrupted %s jobs', cur.rowcount, source)
+        return cur.rowcount
+
+    def counts(self, source: str) -> dict[str, int]:
+        rows = self.db.execute('SELECT state, COUNT(*) AS n FROM jobs WHERE source = ? GROUP BY state;', (source,))
+        return {row['state']: row['n'] for row in rows}
+
+    def close(self) -> None:
+        self.db.close()
+
+
+_queue: JobQueue | None = None
+
+
+def get_queue() -> JobQueue:
+    """Return the shared queue, opened on first use."""
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
+
+
+async def run_workers(
+    source: str,
+    handle: Callable[[Job], Awaitable[None]],
+    workers: int = 1,
+    only: Mapping[str, Collection[Any]] | None = None,
+) -> None:
+    """Drain the ready jobs of a source with `workers` concurrent workers.
+
+    `handle` finishes a job with `done` or `drop`; if it raises, the job is retried later.
+    `only` limits the run to matching jobs, see `JobQueue.get`.
+    """
+    queue = get_queue()
+    queue.recover(source)
+
+    async def _worker() -> None:
+        while (job := queue.get(source, only)) is not None:
+            try:
+                await handle(job)
+            except Exception as e:
+                log.debug('Job %s %s raised', source, job.key, exc_info=True)
+                queue.fail(job, str(e) or type(e).__name__)
+
+    await asyncio.gather(*[_worker() for _ in range(max(1, workers))])
+    log.info('%s queue: %s', source, ', '.join(f'{n} {state}' for state, n in sorted(queue.counts(source).items())) or 'empty')
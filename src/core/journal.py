@@ -0,0 +1,96 @@
+"""Persistent journal of partially downloaded items.
+
+Each in-progress item owns a scratch directory under `./data/journal/<source>/<key>`
+holding its partial files and a small `state.json`. The directory survives crashes,
+so the next run can pick the item up where it stopped. The `a`-prefixed methods do the
+same on the filesystem pool, for use from the event loop.
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from . import fs, logger
+
+log = logger.get('journal')
+
+JOURNAL_DIR = Path('./data/journal')
+STATE_FILE = 'state.json'
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+
+class Journal:
+    """Journal of in-progress items for one source."""
+
+    def __init__(self, source: str, root: Path = JOURNAL_DIR) -> None:
+        self.source = source
+        self.root = root.resolve() / source
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def scratch(self, key: str | int) -> Path:
+        """Return the persistent scratch directory of an item, creating it if needed."""
+        path = self.root / str(key)
+        path.mkdir(exist_ok=True)
+        return path
+
+    def load(self, key: str | int) -> dict[str, Any]:
+        """Load the saved state of an item, or an empty dict if there is none."""
+        path = self.root / str(key) / STATE_FILE
+        try:
+            return json.loads(path.read_text())
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            log.warning('Corrupted journal state %s, starting over', path)
+            return {}
+
+    def save(self, key: str | int, state: dict[str, Any]) -> None:
+        """Atomically persist the state of an item."""
+        self._write(key, json.dumps(state))
+
+    def _write(self, key: str | int, text: str) -> None:
+        path = self.scratch(key) / STATE_FILE
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(text)
+        tmp_path.replace(path)
+
+    def finish(self, key: str | int) -> None:
+        """Drop an item from the journal once it is committed to the library."""
+        shutil.rmtree(self.root / str(key), ignore_errors=True)
+
+    async def ascratch(self, key: str | int) -> Path:
+        return await fs.run(self.scratch, key)
+
+    async def aload(self, key: str | int) -> dict[str, Any]:
+        return await fs.run(self.load, key)
+
+    async def asave(self, key: str | int, state: dict[str, Any]) -> None:
+        """Persist the state of an item; saves of one item are serialised, so the latest one wins."""
+        async with self._locks.setdefault(str(key), asyncio.Lock()):
+            # encoded here, as the caller may keep changing `state` while it is written
+            await fs.run(self._write, key, json.dumps(state))
+
+    async def afinish(self, key: str | int) -> None:
+        self._locks.pop(str(key), None)
+        await fs.run(self.finish, key)
+
+    def gc(self, max_age: float = DEFAULT_MAX_AGE, legacy_prefix: str | None = None) -> None:
+        """Remove scratch dirs untouched for `max_age` seconds and leaked legacy temp dirs."""
+        now = time.time()
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.is_dir() and now - entry.stat().st_mtime > max_age:
+                    log.info('Removing stale scratch dir %s', entry.path)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        if legacy_prefix:
+            with os.scandir(tempfile.gettempdir()) as it:
+                for entry in it:
+                    if entry.name.startswith(legacy_prefix) and entry.is_dir():
+                        log.info('Removing leaked temp dir %s', entry.path)
+                        shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,62 @@
+"""Event-loop lag monitor.
+
+A background task sleeps for a short interval and measures how much later than asked it
+wakes up. Anything beyond a millisecond or two means some call blocked the loop, and
+with it every download in flight.
+"""
+
+import asyncio
+import collections
+
+from . import logger
+
+log = logger.get('lag')
+
+INTERVAL = 0.05
+# single stalls above this are logged as they happen
+STALL_THRESHOLD = 0.5
+
+
+class LagMonitor:
+    def __init__(self, interval: float = INTERVAL, max_samples: int = 100_000) -> None:
+        self.interval = interval
+        self.samples: collections.deque[float] = collections.deque(maxlen=max_samples)
+        self.stalls = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0)
+            self.samples.append(lag)
+            if lag > STALL_THRESHOLD:
+                self.stalls += 1
+                log.debug('Event loop blocked for %.0f ms', lag * 1000)
+
+    def summary(self) -> dict[str, float]:
+        """p50/p99/max lag in milliseconds."""
+        if not self.samples:
+            return {}
+        lags = sorted(self.samples)
+        return {
+            'p50': lags[len(lags) // 2] * 1000,
+            'p99': lags[len(lags) * 99 // 100] * 1000,
+            'max': lags[-1] * 1000,
+        }
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if stats := self.summary():
+            log.info(
+                'Event loop lag p50 %.1f ms, p99 %.1f ms, max %.0f ms, %d stalls over %.0f ms',
+                stats['p50'], stats['p99'], stats['max'], self.stalls, STALL_THRESHOLD * 1000,
+            )
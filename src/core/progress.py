@@ -0,0 +1,157 @@
+"""Central progress aggregation for concurrent downloads.
+
+Download paths report byte deltas to a `Tracker`, which only bumps plain integer
+counters. A single render task redraws tqdm bars at a fixed rate, or writes periodic
+log lines when stderr is not a TTY (e.g. in Docker).
+"""
+
+import asyncio
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from tqdm import tqdm
+
+from . import logger
+
+log = logger.get('progress')
+
+RENDER_INTERVAL = 0.5
+LOG_INTERVAL = 30.0
+
+
+def _fmt_bytes(size: float) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:  # noqa: PLR2004
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TiB'
+
+
+@dataclass(eq=False)
+class Tracker:
+    """Byte counters of a single item."""
+
+    source: str
+    key: str
+    desc: str
+    total: int = 0
+    done: int = 0
+    parts: int | None = None
+    started: float = field(default_factory=time.monotonic)
+    closed: bool = False
+    _known_parts: int = 0
+    _known_bytes: int = 0
+
+    def update(self, delta: int) -> None:
+        """Add downloaded bytes."""
+        self.done += delta
+
+    def set(self, done: int, total: int | None = None) -> None:
+        """Set absolute progress, used by callbacks reporting the current offset."""
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def add_part(self, size: int) -> None:
+        """Record the size of one part and re-estimate the total from the average part size."""
+        self._known_parts += 1
+        self._known_bytes += size
+        if self.parts:
+            self.total = self._known_bytes * self.parts // self._known_parts
+        else:
+            self.total = self._known_bytes
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class ProgressAggregator:
+    """Collects progress from all trackers and renders it at a fixed rate."""
+
+    def __init__(self, interval: float = RENDER_INTERVAL, log_interval: float = LOG_INTERVAL) -> None:
+        self.interval = interval
+        self.log_interval = log_interval
+        self.tty = sys.stderr.isatty()
+        self._trackers: list[Tracker] = []
+        self._bars: dict[Tracker, tqdm] = {}
+        self._task: asyncio.Task | None = None
+        self._last_log = 0.0
+        self._finished: dict[str, int] = defaultdict(int)
+
+    def track(self, source: str, key: str | int, desc: str, total: int = 0, parts: int | None = None) -> Tracker:
+        """Register a new item and start the render task if needed."""
+        tracker = Tracker(source=source, key=str(key), desc=desc, total=total, parts=parts)
+        self._trackers.append(tracker)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return tracker
+
+    def totals(self) -> dict[str, tuple[int, int]]:
+        """Return (done, total) bytes per source, including finished items."""
+        result: dict[str, list[int]] = defaultdict(lambda: [0, 0])
+        for source, done in self._finished.items():
+            result[source][0] += done
+            result[source][1] += done
+        for t in self._trackers:
+            result[t.source][0] += t.done
+            result[t.source][1] += max(t.total, t.done)
+        return {k: (v[0], v[1]) for k, v in result.items()}
+
+    async def _run(self) -> None:
+        try:
+            while self._trackers:
+                self.render()
+                await asyncio.sleep(self.interval)
+        finally:
+            self.render()
+
+    def render(self) -> None:
+        """Redraw bars (TTY) or emit a summary line (non-TTY), then drop closed trackers."""
+        if self.tty:
+            self._render_bars()
+        else:
+            self._render_log()
+        for t in [t for t in self._trackers if t.closed]:
+            self._trackers.remove(t)
+            self._finished[t.source] += t.done
+            bar = self._bars.pop(t, None)
+            if bar is not None:
+                bar.close()
+
+    def _render_bars(self) -> None:
+        for t in self._trackers:
+            bar = self._bars.get(t)
+            if bar is None:
+                bar = tqdm(total=0, unit='B', unit_scale=True, desc=t.desc, dynamic_ncols=True)
+                self._bars[t] = bar
+            bar.total = max(t.total, t.done)
+            bar.n = t.done
+            bar.refresh()
+
+    def _render_log(self) -> None:
+        now = time.monotonic()
+        closed = [t for t in self._trackers if t.closed]
+        if now - self._last_log < self.log_interval and not closed:
+            return
+        self._last_log = now
+        for t in closed:
+            elapsed = max(now - t.started, 1e-6)
+            log.info('[%s] %s done: %s in %.0fs (%s/s)', t.source, t.desc, _fmt_bytes(t.done), elapsed, _fmt_bytes(t.done / elapsed))
+        active: dict[str, list[Tracker]] = defaultdict(list)
+        for t in self._trackers:
+            if not t.closed:
+                active[t.source].append(t)
+        for source, trackers in active.items():
+            done = sum(t.done for t in trackers)
+            total = sum(max(t.total, t.done) for t in trackers)
+            log.info('[%s] %d active, %s / %s', source, len(trackers), _fmt_bytes(done), _fmt_bytes(total))
+
+
+aggregator = ProgressAggregator()
+
+
+def track(source: str, key: str | int, desc: str, total: int = 0, parts: int | None = None) -> Tracker:
+    """Register an item with the shared aggregator."""
+    return aggregator.track(source, key, desc, total=total, parts=parts)
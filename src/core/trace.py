@@ -0,0 +1,121 @@
+"""Lightweight per-item span tracing in Chrome trace-event format.
+
+Spans are written to `./data/trace/<timestamp>.json`, which can be opened in
+chrome://tracing or Perfetto to see a whole run as a timeline with one row per item.
+Tracing is off by default; when it is off, or an item is not sampled, `span` returns a
+shared no-op context manager.
+"""
+
+import atexit
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import random
+import time
+from collections.abc import Iterator
+from datetime import datetime
+from typing import IO, Any, Self
+
+from .config import config
+
+_NOOP = contextlib.nullcontext()
+
+
+class _Lane:
+    __slots__ = ('sampled', 'tid')
+
+    def __init__(self, tid: int, *, sampled: bool) -> None:
+        self.tid = tid
+        self.sampled = sampled
+
+
+_lane: contextvars.ContextVar[_Lane | None] = contextvars.ContextVar('trace_lane', default=None)
+
+
+class _Span:
+    __slots__ = ('args', 'name', 'start', 'tid', 'tracer')
+
+    def __init__(self, tracer: 'Tracer', name: str, tid: int, args: dict[str, Any]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.tid = tid
+        self.args = args
+
+    def __enter__(self) -> Self:
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *_: object) -> None:
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.emit({
+            'name': self.name,
+            'ph': 'X',
+            'ts': self.start // 1000,
+            'dur': (end - self.start) // 1000,
+            'pid': os.getpid(),
+            'tid': self.tid,
+            'args': self.args,
+        })
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self._enabled: bool | None = None
+        self._file: IO[str] | None = None
+        self._tids = itertools.count(1)
+
+    @property
+    def enabled(self) -> bool:
+        if self._enabled is None:
+            self._enabled = config.trace.enabled
+        return self._enabled
+
+    def emit(self, event: dict[str, Any]) -> None:
+        if self._file is None:
+            path = config.trace.path
+            path.mkdir(parents=True, exist_ok=True)
+            self._file = (path / f'{datetime.now().astimezone().strftime("%Y%m%d-%H%M%S")}.json').open('w')
+            # the trace-event format accepts an unterminated array, so a crashed run is still readable
+            self._file.write('[\n')
+            atexit.register(self.close)
+        self._file.write(json.dumps(event, ensure_ascii=False) + ',\n')
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @contextlib.contextmanager
+    def lane(self, source: str, key: str | int | None = None) -> Iterator[None]:
+        """Group the spans of one item (or of a source's discovery) on their own timeline row."""
+        if not self.enabled:
+            yield
+            return
+        sampled = key is None or random.random() < config.trace.sample_rate  # noqa: S311
+        lane = _Lane(next(self._tids), sampled=sampled)
+        if sampled:
+            name = source if key is None else f'{source} {key}'
+            self.emit({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': lane.tid, 'args': {'name': name}})
+        token = _lane.set(lane)
+        try:
+            yield
+        finally:
+            _lane.reset(token)
+
+    def span(self, name: str, **args: Any) -> contextlib.AbstractContextManager:
+        """Time a stage of the current item."""
+        if not self.enabled:
+            return _NOOP
+        lane = _lane.get()
+        if lane is None or not lane.sampled:
+            return _NOOP
+        return _Span(self, name, lane.tid, args)
+
+
+tracer = Tracer()
+lane = tracer.lane
+span = tracer.span
@@ -1,5 +1,27 @@
+from typing import Any
+
 from . import cloudflare
-from .cookiecloud import CookieCloudClient
+from .faststart import ensure_faststart
 from .filename import ensure_unique_path, format_video_filename, sanitize
+from .mediaserver import notifier
+
+
+def __getattr__(name: str) -> Any:
+    # pycryptodome is only needed by sources that sync cookies, import it on demand
+    if name == 'CookieCloudClient':
+        from .cookiecloud import CookieCloudClient  # noqa: PLC0415
+
+        return CookieCloudClient
+    msg = f'module {__name__!r} has no attribute {name!r}'
+    raise AttributeError(msg)
+
 
-__all__ = ['CookieCloudClient', 'cloudflare', 'sanitize', 'format_video_filename', 'ensure_unique_path']
+__all__ = [
+    'CookieCloudClient',
+    'cloudflare',
+    'ensure_faststart',
+    'ensure_unique_path',
+    'format_video_filename',
+    'notifier',
+    'sanitize',
+]
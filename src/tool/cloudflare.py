@@ -1,71 +1,266 @@
-from typing import Any
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any, Self
 
 import httpx
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    before_sleep_log,
+    retry_if_exception,
+    retry_if_result,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 from src.core import config, logger
 
-cfg = config.cloudflare
 log = logger.get('cloudflare')
 
+API_BASE = 'https://api.cloudflare.com/client/v4/accounts'
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
 
-async_client = httpx.AsyncClient(
-    headers={
-        'Authorization': f'Bearer {cfg.api_key}',
-    },
-    proxy=config.proxy if config.proxy else None,
-    timeout=30,
-)
 
-client = httpx.Client(
-    headers={
-        'Authorization': f'Bearer {cfg.api_key}',
-    },
-    proxy=config.proxy if config.proxy else None,
-    timeout=30,
-)
+def _is_idempotent_sql(query: str) -> bool:
+    """Whether re-sending a statement after an unknown outcome is safe.
+
+    Plain INSERTs fail on the primary key when the first attempt did land, everything else
+    used here (SELECT, CREATE IF NOT EXISTS, UPDATE/DELETE to fixed values, upserts) is safe.
+    """
+    sql = ' '.join(query.split()).upper()
+    if not sql.startswith('INSERT'):
+        return True
+    return sql.startswith(('INSERT OR IGNORE', 'INSERT OR REPLACE')) or 'ON CONFLICT' in sql
+
+
+def _is_read_sql(query: str) -> bool:
+    return query.lstrip().upper().startswith(('SELECT', 'PRAGMA'))
+
+
+class CloudflareClient:
+    """Pooled client for the D1 and KV APIs with retries and request coalescing."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        account_id: str,
+        api_key: str,
+        d1_id: str,
+        *,
+        proxy: str | None = None,
+        timeout: float = 30,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        http2: bool = False,
+        retries: int = 5,
+    ) -> None:
+        self.account_id = account_id
+        self.d1_id = d1_id
+        self.retries = retries
+        self._client_kwargs = {
+            'headers': {'Authorization': f'Bearer {api_key}'},
+            'proxy': proxy,
+            'timeout': timeout,
+            'limits': httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+        }
+        self.http2 = http2
+        self._async_client: httpx.AsyncClient | None = None
+        self._client: httpx.Client | None = None
+        self._inflight: dict[tuple, asyncio.Future] = {}
+
+    @classmethod
+    def from_config(cls) -> 'CloudflareClient':
+        cfg = config.cloudflare
+        return cls(
+            cfg.account_id,
+            cfg.api_key,
+            cfg.d1_id,
+            proxy=config.proxy if config.proxy else None,
+            timeout=cfg.timeout,
+            max_connections=cfg.max_connections,
+            max_keepalive_connections=cfg.max_keepalive_connections,
+            http2=cfg.http2,
+            retries=cfg.retries,
+        )
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            try:
+                self._async_client = httpx.AsyncClient(http2=self.http2, **self._client_kwargs)
+            except ImportError:
+                log.warning('HTTP/2 requested but the h2 package is not installed, falling back to HTTP/1.1')
+                self.http2 = False
+                self._async_client = httpx.AsyncClient(**self._client_kwargs)
+        return self._async_client
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            self._client = httpx.Client(**self._client_kwargs)
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.aclose()
+
+    def _retry_kwargs(self, *, idempotent: bool) -> dict[str, Any]:
+        def _retry_exc(e: BaseException) -> bool:
+            if idempotent:
+                return isinstance(e, httpx.TransportError)
+            # the request never reached the server, so resending cannot apply it twice
+            return isinstance(e, httpx.ConnectError | httpx.ConnectTimeout | httpx.PoolTimeout)
+
+        def _retry_res(res: httpx.Response) -> bool:
+            if idempotent:
+                return res.status_code in RETRY_STATUS
+            return res.status_code == httpx.codes.TOO_MANY_REQUESTS
+
+        return {
+            'stop': stop_after_attempt(self.retries),
+            'wait': wait_random_exponential(multiplier=0.5, max=30),
+            'retry': retry_if_exception(_retry_exc) | retry_if_result(_retry_res),
+            'before_sleep': before_sleep_log(log, logging.WARNING),
+            # hand the last response back so callers report the actual status
+            'retry_error_callback': lambda state: state.outcome.result(),
+        }
 
+    async def request(self, method: str, url: str, *, idempotent: bool, **kwargs: Any) -> httpx.Response:
+        """Send a request, retrying transient failures with jittered exponential backoff."""
+        return await AsyncRetrying(**self._retry_kwargs(idempotent=idempotent))(self.async_client.request, method, url, **kwargs)
 
-async def query_d1(query: str, params: tuple[str, ...] = ()) -> list[dict[str, Any]]:
-    url = f'https://api.cloudflare.com/client/v4/accounts/{cfg.account_id}/d1/database/{cfg.d1_id}/query'
-    res = await async_client.post(url, json={'sql': query, 'params': params})
-    try:
-        res.raise_for_status()
-    except httpx.HTTPStatusError as e:
-        msg = f'Failed to query database: {res.status_code}\n{res.text}'
-        raise ValueError(msg) from e
-
-    data = res.json()
-    if not data['success']:
-        log.exception('Query failed: %s', data)
-        msg = f'Query failed: {data}'
-        raise ValueError(msg)
-    result = data['result'][0]
-    if not result['success']:
-        log.exception('Query failed: %s', result)
-        msg = f'Query failed: {result}'
-        raise ValueError(msg)
-    return result['results']
+    async def _coalesce(self, key: tuple, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Share one in-flight request between identical concurrent reads."""
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(factory())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            log.debug('Coalesced request %s', key)
+        return await asyncio.shield(fut)
+
+    async def query_d1(self, query: str, params: tuple[str, ...] = (), *, idempotent: bool | None = None) -> list[dict[str, Any]]:
+        if _is_read_sql(query):
+            return await self._coalesce(('d1', query, tuple(params)), lambda: self._query_d1(query, params, idempotent=True))
+        if idempotent is None:
+            idempotent = _is_idempotent_sql(query)
+        return await self._query_d1(query, params, idempotent=idempotent)
+
+    async def _query_d1(self, query: str, params: tuple[str, ...], *, idempotent: bool) -> list[dict[str, Any]]:
+        url = f'{API_BASE}/{self.account_id}/d1/database/{self.d1_id}/query'
+        res = await self.request('POST', url, idempotent=idempotent, json={'sql': query, 'params': params})
+        try:
+            res.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            msg = f'Failed to query database: {res.status_code}\n{res.text}'
+            raise ValueError(msg) from e
+
+        data = res.json()
+        if not data['success']:
+            log.exception('Query failed: %s', data)
+            msg = f'Query failed: {data}'
+            raise ValueError(msg)
+        result = data['result'][0]
+        if not result['success']:
+            log.exception('Query failed: %s', result)
+            msg = f'Query failed: {result}'
+            raise ValueError(msg)
+        return result['results']
+
+    async def get_kv(self, kv_id: str, key: str | int) -> httpx.Response:
+        return await self._coalesce(('kv', kv_id, str(key)), lambda: self._get_kv(kv_id, key))
+
+    async def _get_kv(self, kv_id: str, key: str | int) -> httpx.Response:
+        url = f'{API_BASE}/{self.account_id}/storage/kv/namespaces/{kv_id}/values/{key}'
+        res = await self.request('GET', url, idempotent=True)
+        try:
+            res.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            log.exception('Failed to get key: %s', res.text)
+            msg = f'Failed to get key: {res.status_code}\n{res.text}'
+            raise ValueError(msg) from e
+        return res
+
+    async def list_kv_keys(self, kv_id: str, prefix: str | None = None) -> list[dict[str, Any]]:
+        """List all keys of a KV namespace with their `expiration` (unix seconds) if any."""
+        return await self._coalesce(('kv-keys', kv_id, prefix), lambda: self._list_kv_keys(kv_id, prefix))
+
+    async def _list_kv_keys(self, kv_id: str, prefix: str | None) -> list[dict[str, Any]]:
+        url = f'{API_BASE}/{self.account_id}/storage/kv/namespaces/{kv_id}/keys'
+        keys = []
+        cursor = None
+        while True:
+            params = {'limit': 1000}
+            if prefix:
+                params['prefix'] = prefix
+            if cursor:
+                params['cursor'] = cursor
+            res = await self.request('GET', url, idempotent=True, params=params)
+            try:
+                res.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                log.exception('Failed to list keys: %s', res.text)
+                msg = f'Failed to list keys: {res.status_code}\n{res.text}'
+                raise ValueError(msg) from e
+            data = res.json()
+            keys += data['result']
+            cursor = data.get('result_info', {}).get('cursor')
+            if not cursor:
+                return keys
+
+    def sync_get_kv(self, kv_id: str, key: str | int) -> httpx.Response:
+        url = f'{API_BASE}/{self.account_id}/storage/kv/namespaces/{kv_id}/values/{key}'
+        res = Retrying(**self._retry_kwargs(idempotent=True))(self.client.get, url)
+        try:
+            res.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            log.exception('Failed to get key: %s', res.text)
+            msg = f'Failed to get key: {res.status_code}\n{res.text}'
+            raise ValueError(msg) from e
+        return res
+
+
+_default: CloudflareClient | None = None
+
+
+def get_client() -> CloudflareClient:
+    """Return the shared client, created on first use instead of at import time."""
+    global _default
+    if _default is None:
+        _default = CloudflareClient.from_config()
+    return _default
+
+
+async def aclose() -> None:
+    """Close the shared client, if it was ever created."""
+    global _default
+    if _default is not None:
+        await _default.aclose()
+        _default = None
+
+
+async def query_d1(query: str, params: tuple[str, ...] = (), *, idempotent: bool | None = None) -> list[dict[str, Any]]:
+    return await get_client().query_d1(query, params, idempotent=idempotent)
 
 
 async def get_kv(kv_id: str, key: str | int) -> httpx.Response:
-    url = f'https://api.cloudflare.com/client/v4/accounts/{cfg.account_id}/storage/kv/namespaces/{kv_id}/values/{key}'
-    res = await async_client.get(url)
-    try:
-        res.raise_for_status()
-    except httpx.HTTPStatusError as e:
-        log.exception('Failed to get key: %s', res.text)
-        msg = f'Failed to get key: {res.status_code}\n{res.text}'
-        raise ValueError(msg) from e
-    return res
+    return await get_client().get_kv(kv_id, key)
+
+
+async def list_kv_keys(kv_id: str, prefix: str | None = None) -> list[dict[str, Any]]:
+    return await get_client().list_kv_keys(kv_id, prefix)
 
 
 def sync_get_kv(kv_id: str, key: str | int) -> httpx.Response:
-    url = f'https://api.cloudflare.com/client/v4/accounts/{cfg.account_id}/storage/kv/namespaces/{kv_id}/values/{key}'
-    res = client.get(url)
-    try:
-        res.raise_for_status()
-    except httpx.HTTPStatusError as e:
-        log.exception('Failed to get key: %s', res.text)
-        msg = f'Failed to get key: {res.status_code}\n{res.text}'
-        raise ValueError(msg) from e
-    return res
+    return get_client().sync_get_kv(kv_id, key)
@@ -89,9 +89,15 @@ class CookieCloudClient:
             output_path (str or Path): Path where to save the cookie file
 
         """
-        if isinstance(output_path, str):
-            output_path = Path(output_path)
+        Path(output_path).write_text(self.to_netscape_format(domain))
 
+    def to_netscape_format(self, domain: str) -> str:
+        """Render the cookies of a specific domain in Netscape cookie.txt format.
+
+        Args:
+            domain (str): The domain to extract cookies for (e.g., 'bilibili.com')
+
+        """
         cookies = self.get_cookies()
         if domain not in cookies:
             msg = f'No cookies found for domain: {domain}'
@@ -116,4 +122,4 @@ class CookieCloudClient:
             line += f'{cookie["value"]}'
             cookie_content.append(line)
 
-        output_path.write_text('\n'.join(cookie_content))
+        return '\n'.join(cookie_content)
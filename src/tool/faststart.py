@@ -0,0 +1,116 @@
+"""Move the `moov` atom of MP4 files to the front so playback can start before the whole file is read."""
+
+import asyncio
+import os
+import shutil
+import struct
+from pathlib import Path
+
+from src.core import config, fs, logger
+
+log = logger.get('faststart')
+
+MP4_SUFFIXES = frozenset({'.mp4', '.m4v', '.mov'})
+HEADER = struct.Struct('>I4s')
+LARGE_SIZE = struct.Struct('>Q')
+
+
+def read_boxes(path: Path) -> list[tuple[str, int, int]]:
+    """Read the top-level box headers of an MP4 file without touching the payloads.
+
+    Returns:
+        list of (type, offset, size); a truncated last box is reported with its declared size
+
+    """
+    boxes = []
+    file_size = path.stat().st_size
+    with path.open('rb') as f:
+        offset = 0
+        while offset + HEADER.size <= file_size:
+            f.seek(offset)
+            size, kind = HEADER.unpack(f.read(HEADER.size))
+            header_size = HEADER.size
+            if size == 1:
+                size = LARGE_SIZE.unpack(f.read(LARGE_SIZE.size))[0]
+                header_size += LARGE_SIZE.size
+            elif size == 0:
+                size = file_size - offset
+            boxes.append((kind.decode('latin-1'), offset, size))
+            if size < header_size:
+                break
+            offset += size
+    return boxes
+
+
+def needs_faststart(path: Path) -> bool:
+    """Whether `moov` comes after `mdat` in the file."""
+    kinds = [kind for kind, _, _ in read_boxes(path)]
+    if 'moov' not in kinds or 'mdat' not in kinds:
+        return False
+    return kinds.index('moov') > kinds.index('mdat')
+
+
+class Faststart:
+    """Remux files with `-movflags +faststart`, bounded by CPU count and free scratch space."""
+
+    def __init__(self, workers: int | None = None) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self._slots = asyncio.Semaphore(self.workers)
+        self._space = asyncio.Condition()
+        self._reserved: dict[int, int] = {}
+
+    async def _reserve(self, path: Path, size: int) -> bool:
+        dev = (await fs.run(path.stat)).st_dev
+        async with self._space:
+            while True:
+                free = (await fs.run(shutil.disk_usage, path.parent)).free
+                reserved = self._reserved.get(dev, 0)
+                if size <= free - reserved:
+                    self._reserved[dev] = reserved + size
+                    return True
+                if not reserved:
+                    return False
+                await self._space.wait()
+
+    async def _release(self, path: Path, size: int) -> None:
+        dev = (await fs.run(path.stat)).st_dev
+        async with self._space:
+            self._reserved[dev] -= size
+            self._space.notify_all()
+
+    async def process(self, path: Path) -> bool:
+        """Remux `path` in place if its layout needs it. Returns whether the file was rewritten."""
+        if path.suffix.lower() not in MP4_SUFFIXES or not await asyncio.to_thread(needs_faststart, path):
+            return False
+        size = await fs.size(path)
+        if not await self._reserve(path, size):
+            log.warning('Not enough space to remux %s, keeping it as is', path.name)
+            return False
+        tmp_path = path.with_name(f'{path.stem}.faststart{path.suffix}')
+        try:
+            async with self._slots:
+                log.info('Remuxing %s for faststart', path.name)
+                proc = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-hide_banner', '-loglevel', 'warning', '-i', str(path),
+                    '-map', '0', '-c', 'copy', '-movflags', '+faststart', '-y', str(tmp_path),
+                    stderr=asyncio.subprocess.PIPE,
+                )  # fmt: skip
+                _, stderr = await proc.communicate()
+            if proc.returncode != 0:
+                log.error('Failed to remux %s: %s', path.name, stderr.decode().strip())
+                await fs.unlink(tmp_path, missing_ok=True)
+                return False
+            await fs.replace(tmp_path, path)
+            return True
+        finally:
+            await self._release(path, size)
+
+
+_faststart = Faststart()
+
+
+async def ensure_faststart(path: Path) -> bool:
+    """Run the faststart stage on `path` when enabled in the config."""
+    if not config.faststart:
+        return False
+    return await _faststart.process(path)
@@ -3,6 +3,8 @@
 import re
 from pathlib import Path
 
+from src.core import fs
+
 # Invalid characters for filenames across different OS
 INVALID_CHARS = r'[<>:"/\\|?*\n]'
 
@@ -81,9 +83,11 @@ def format_video_filename(
     return f'{filename}.{ext}'
 
 
-def ensure_unique_path(path: Path) -> Path:
+async def ensure_unique_path(path: Path) -> Path:
     """
     Ensure the path is unique by appending a counter if it already exists.
+
+    The probes run on the filesystem thread pool, so a slow library share does not block the event loop.
     
     Args:
         path: The original path
@@ -91,6 +95,10 @@ def ensure_unique_path(path: Path) -> Path:
     Returns:
         A unique path that doesn't exist
     """
+    return await fs.run(_unique_path, path)
+
+
+def _unique_path(path: Path) -> Path:
     if not path.exists():
         return path
     
@@ -100,4 +108,3 @@ def ensure_unique_path(path: Path) -> Path:
         if not new_path.exists():
             return new_path
         counter += 1
-
@@ -0,0 +1,168 @@
+"""Lease-based work claiming on D1, so several workers can share one backlog.
+
+A worker claims an item with an atomic conditional write that sets `worker_id` and
+`lease_until`, renews its leases with a heartbeat while downloading, and releases them
+when done. If a worker dies, its leases simply expire and another worker takes over.
+
+Items that already have a row before they are downloaded (tx) are leased on their own
+table; the others (bilibili, telegram) are leased through a shared `leases` table.
+"""
+
+import asyncio
+import os
+import socket
+import time
+
+import httpx
+
+from src.core import config, logger
+
+from . import cloudflare
+
+log = logger.get('lease')
+
+
+class Leases:
+    def __init__(
+        self,
+        source: str,
+        *,
+        table: str | None = None,
+        key_column: str = 'id',
+        pending: str = '1 = 1',
+        done: str | None = None,
+    ) -> None:
+        """Lease items of one source.
+
+        Args:
+            source: name of the source, used as the key namespace in the `leases` table
+            table: lease directly on this table's `worker_id`/`lease_until` columns instead of `leases`
+            key_column: primary key column of `table`
+            pending: condition on `table` rows that may still be claimed
+            done: query with one `?` returning a row once the item is committed, checked when claiming via `leases`
+
+        """
+        cfg = config.worker
+        self.enabled = cfg.enabled
+        self.source = source
+        self.worker_id = cfg.id or f'{socket.gethostname()}-{os.getpid()}'
+        self.ttl = cfg.lease_ttl
+        self.table = table
+        self.key_column = key_column
+        self.pending = pending
+        self.done = done
+        self._held: set[str] = set()
+        # claims lost to other workers, summarised on close
+        self.missed = 0
+        self._heartbeat: asyncio.Task | None = None
+
+    async def init(self) -> None:
+        """Create the lease table or columns if they are missing."""
+        if not self.enabled:
+            return
+        if self.table is None:
+            await cloudflare.query_d1("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    source TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    worker_id TEXT NOT NULL,
+                    lease_until INTEGER NOT NULL,
+                    PRIMARY KEY (source, item)
+                );
+            """)
+            return
+        columns = {c['name'] for c in await cloudflare.query_d1(f"SELECT name FROM pragma_table_info('{self.table}');")}  # noqa: S608
+        if 'worker_id' not in columns:
+            await cloudflare.query_d1(f'ALTER TABLE {self.table} ADD COLUMN worker_id TEXT;')
+        if 'lease_until' not in columns:
+            await cloudflare.query_d1(f'ALTER TABLE {self.table} ADD COLUMN lease_until INTEGER;')
+        log.debug('lease columns on %s initialized', self.table)
+
+    def available(self) -> str:
+        """SQL condition matching rows of `table` not leased by another worker."""
+        if not self.enabled:
+            return '1 = 1'
+        worker_id = self.worker_id.replace("'", "''")
+        return f"(lease_until IS NULL OR lease_until < unixepoch() OR worker_id = '{worker_id}')"
+
+    async def claim(self, key: str | int) -> bool:
+        """Try to take the lease of an item. Returns False if another worker holds it or it is done."""
+        if not self.enabled:
+            return True
+        key = str(key)
+        now = int(time.time())
+        if self.table is None:
+            done = f'WHERE NOT EXISTS ({self.done})' if self.done else 'WHERE 1 = 1'
+            rows = await cloudflare.query_d1(
+                f"""
+                INSERT INTO leases (source, item, worker_id, lease_until) SELECT ?, ?, ?, ? {done}
+                ON CONFLICT (source, item) DO UPDATE SET worker_id = excluded.worker_id, lease_until = excluded.lease_until
+                WHERE leases.lease_until < ? OR leases.worker_id = excluded.worker_id
+                RETURNING item;
+                """,
+                (self.source, key, self.worker_id, str(now + self.ttl), *([key] if self.done else []), str(now)),
+            )
+        else:
+            rows = await cloudflare.query_d1(
+                f"""
+                UPDATE {self.table} SET worker_id = ?, lease_until = ?
+                WHERE {self.key_column} = ? AND {self.pending} AND (lease_until IS NULL OR lease_until < ? OR worker_id = ?)
+                RETURNING {self.key_column};
+                """,  # noqa: S608
+                (self.worker_id, str(now + self.ttl), key, str(now), self.worker_id),
+            )
+        if not rows:
+            log.debug('%s %s is taken by another worker', self.source, key)
+            self.missed += 1
+            return False
+        self._held.add(key)
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._renew())
+        return True
+
+    async def release(self, key: str | int) -> None:
+        """Give up the lease of an item, whether it was committed or failed."""
+        if not self.enabled:
+            return
+        key = str(key)
+        self._held.discard(key)
+        if self.table is None:
+            await cloudflare.query_d1(
+                'DELETE FROM leases WHERE source = ? AND item = ? AND worker_id = ?;',
+                (self.source, key, self.worker_id),
+            )
+        else:
+            await cloudflare.query_d1(
+                f'UPDATE {self.table} SET worker_id = NULL, lease_until = NULL WHERE {self.key_column} = ? AND worker_id = ?;',  # noqa: S608
+                (key, self.worker_id),
+            )
+
+    async def _renew(self) -> None:
+        """Extend all held leases every third of the TTL until none are left."""
+        while self._held:
+            await asyncio.sleep(self.ttl / 3)
+            if not self._held:
+                break
+            until = str(int(time.time()) + self.ttl)
+            try:
+                if self.table is None:
+                    await cloudflare.query_d1(
+                        'UPDATE leases SET lease_until = ? WHERE source = ? AND worker_id = ?;',
+                        (until, self.source, self.worker_id),
+                    )
+                else:
+                    await cloudflare.query_d1(
+                        f'UPDATE {self.table} SET lease_until = ? WHERE worker_id = ? AND {self.pending};',  # noqa: S608
+                        (until, self.worker_id),
+                    )
+            except (ValueError, httpx.HTTPError):
+                # keep beating, a later renewal can still make it before the leases expire
+                log.exception('Failed to renew leases of %s', self.source)
+
+    async def close(self) -> None:
+        if self.missed:
+            log.info('%d %s items were taken by other workers', self.missed, self.source)
+            self.missed = 0
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
@@ -0,0 +1,76 @@
+"""Tell Emby/Jellyfin about new files instead of waiting for a full library scan.
+
+Sources report each committed file with the metadata they already have. An `.nfo`
+sidecar is written next to it, so the server need not probe the file, and at the end of
+the run all new paths are sent in one `/Library/Media/Updated` request.
+"""
+
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import httpx
+
+from src.core import config, fs, logger
+
+log = logger.get('mediaserver')
+
+
+def write_nfo(video_path: Path, *, source: str, video_id: str, title: str, uploader: str | None = None) -> Path:
+    """Write a Kodi-style movie .nfo next to a video, as read by Emby and Jellyfin."""
+    root = ET.Element('movie')
+    ET.SubElement(root, 'title').text = title
+    ET.SubElement(root, 'uniqueid', type=source, default='true').text = video_id
+    if uploader:
+        ET.SubElement(root, 'studio').text = uploader
+    ET.SubElement(root, 'tag').text = source
+    ET.indent(root)
+    nfo_path = video_path.with_suffix('.nfo')
+    tmp_path = nfo_path.with_suffix('.tmp')
+    ET.ElementTree(root).write(tmp_path, encoding='utf-8', xml_declaration=True)
+    tmp_path.replace(nfo_path)
+    return nfo_path
+
+
+class Notifier:
+    """Collect the files committed during a run and announce them in one batch."""
+
+    def __init__(self) -> None:
+        self.paths: list[Path] = []
+
+    async def added(self, video_path: Path, *, source: str, video_id: str | int, title: str, uploader: str | None = None) -> None:
+        """Post-commit hook for a new file in a library."""
+        cfg = config.mediaserver
+        if cfg.nfo:
+            try:
+                await fs.run(write_nfo, video_path, source=source, video_id=str(video_id), title=title, uploader=uploader)
+            except OSError:
+                log.exception('Failed to write the .nfo of %s', video_path.name)
+        self.paths.append(video_path)
+
+    def server_path(self, path: Path) -> str:
+        """Translate a local path to the path the media server sees."""
+        path = path.resolve()
+        for local, remote in config.mediaserver.path_map.items():
+            if path.is_relative_to(local):
+                return f'{remote.rstrip("/")}/{path.relative_to(local).as_posix()}'
+        return str(path)
+
+    async def flush(self) -> None:
+        """Send one "paths updated" notification for everything added so far."""
+        cfg = config.mediaserver
+        paths, self.paths = self.paths, []
+        if not cfg.url or not paths:
+            return
+        updates = [{'Path': self.server_path(p), 'UpdateType': 'Created'} for p in paths]
+        try:
+            async with httpx.AsyncClient(base_url=cfg.url, timeout=cfg.timeout) as client:
+                res = await client.post('/Library/Media/Updated', json={'Updates': updates}, headers={'X-Emby-Token': cfg.api_key})
+                res.raise_for_status()
+        except httpx.HTTPError as e:
+            # the next scheduled library scan still picks the files up
+            log.error('Failed to notify the media server of %d new files: %s', len(updates), e)  # noqa: TRY400
+            return
+        log.info('Notified the media server of %d new files', len(updates))
+
+
+notifier = Notifier()
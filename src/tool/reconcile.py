@@ -0,0 +1,218 @@
+"""Find drift between the D1 records and the files in the libraries.
+
+Library roots are walked in parallel with `os.scandir`. A persistent (path, size, mtime)
+index keeps re-scans incremental, so only new or changed files are validated, and the
+cheap container checks run in a process pool. The checks are heuristics, so files found
+broken are moved aside into a `.quarantine` dir next to them rather than deleted.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from src.core import config, fs, logger
+
+from . import cloudflare
+from .faststart import MP4_SUFFIXES, read_boxes
+from .filename import ensure_unique_path
+
+log = logger.get('reconcile')
+
+INDEX_PATH = Path('./data/reconcile.json')
+VIDEO_SUFFIXES = frozenset({*MP4_SUFFIXES, '.mkv', '.webm', '.flv', '.ts'})
+# the id embedded by format_video_filename: "... [id].ext"
+ID_PATTERN = re.compile(r' \[([^\[\]]+)\]\.\w+$')
+BILIBILI_PATTERN = re.compile(r'^\[(?P<upper>.*?)\](?P<title>.*) \[(?P<id>[^\[\]]+)\]\.\w+$')
+INVALID_CHARS = r'[<>:"/\\|?*]'
+QUARANTINE_DIR = '.quarantine'
+
+
+@dataclass(frozen=True)
+class Action:
+    """A fix-up for one drifted item.
+
+    kind is `missing` (row without file), `corrupt` (row with a broken file) or `orphan` (file without row).
+    """
+
+    kind: str
+    source: str
+    id: str
+    path: str | None
+    sql: str | None = None
+    params: tuple[str, ...] = ()
+
+
+def scan_tree(root: str, *, recursive: bool = True) -> list[tuple[str, int, float]]:
+    """Walk a directory iteratively and return (path, size, mtime) of video files."""
+    result = []
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and entry.name != QUARANTINE_DIR:
+                        stack.append(entry.path)
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_SUFFIXES:  # noqa: PTH122
+                    st = entry.stat()
+                    result.append((entry.path, st.st_size, st.st_mtime))
+    return result
+
+
+def validate(path: str) -> bool:
+    """Cheap container check: MP4 boxes must have a moov and end exactly at the end of the file."""
+    p = Path(path)
+    size = p.stat().st_size
+    if size == 0:
+        return False
+    if p.suffix.lower() not in MP4_SUFFIXES:
+        return True
+    try:
+        boxes = read_boxes(p)
+    except (OSError, UnicodeDecodeError):
+        return False
+    if not boxes or 'moov' not in [kind for kind, _, _ in boxes]:
+        return False
+    _, offset, box_size = boxes[-1]
+    return offset + box_size == size
+
+
+class Reconciler:
+    def __init__(self, index_path: Path = INDEX_PATH, workers: int | None = None) -> None:
+        self.index_path = index_path
+        self.workers = workers or os.cpu_count() or 1
+        self.index: dict[str, list] = {}
+        self._roots: list[str] = []
+        self._seen: set[str] = set()
+        if index_path.exists():
+            self.index = json.loads(index_path.read_text())
+
+    async def scan(self, root: Path) -> dict[str, bool]:
+        """Scan a library root in parallel per top-level directory and return path -> valid."""
+        if not await fs.exists(root):
+            return {}
+        self._roots.append(str(root))
+        loop = asyncio.get_running_loop()
+        tops = await fs.run(lambda: [e.path for e in os.scandir(root) if e.is_dir(follow_symlinks=False) and e.name != QUARANTINE_DIR])
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            chunks = await asyncio.gather(
+                *[loop.run_in_executor(pool, scan_tree, top) for top in tops],
+                loop.run_in_executor(pool, functools.partial(scan_tree, str(root), recursive=False)),
+            )
+        files = [f for chunk in chunks for f in chunk]
+
+        result = {}
+        to_check = []
+        self._seen.update(path for path, _, _ in files)
+        for path, size, mtime in files:
+            cached = self.index.get(path)
+            if cached and cached[0] == size and cached[1] == mtime:
+                result[path] = cached[2]
+            else:
+                to_check.append((path, size, mtime))
+        log.info('%s: %d files, %d new or changed', root, len(files), len(to_check))
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            valid = await asyncio.gather(*[loop.run_in_executor(pool, validate, path) for path, _, _ in to_check])
+        for (path, size, mtime), ok in zip(to_check, valid, strict=True):
+            self.index[path] = [size, mtime, ok]
+            result[path] = ok
+        return result
+
+    def save_index(self) -> None:
+        # forget files that are gone from the scanned roots so the index does not grow forever
+        self.index = {p: v for p, v in self.index.items() if p in self._seen or not p.startswith(tuple(self._roots))}
+        tmp_path = self.index_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.index))
+        tmp_path.replace(self.index_path)
+
+    async def bilibili(self) -> list[Action]:
+        cfg = config.bilibili
+        files, rows = await asyncio.gather(self.scan(cfg.path), cloudflare.query_d1('SELECT bvid FROM bilibili;'))
+        by_id = {}
+        for path, ok in files.items():
+            if match := ID_PATTERN.search(Path(path).name):
+                by_id[match.group(1)] = (path, ok)
+        actions = []
+        known = {r['bvid'] for r in rows}
+        for bvid in known:
+            path, ok = by_id.get(bvid, (None, False))
+            if not ok:
+                sql = 'DELETE FROM bilibili WHERE bvid = ?;'
+                actions.append(Action('corrupt' if path else 'missing', 'bilibili', bvid, path, sql, (bvid,)))
+        for bvid, (path, _) in by_id.items():
+            if bvid in known:
+                continue
+            match = BILIBILI_PATTERN.match(Path(path).name)
+            fav_id = -1 if Path(path).parent.name == 'toview' else (cfg.fav_id or 0)
+            sql, params = None, ()
+            if match:
+                sql = 'INSERT OR IGNORE INTO bilibili (bvid, fav_id, title, upper) VALUES (?, ?, ?, ?);'
+                params = (bvid, str(fav_id), match['title'], match['upper'])
+            actions.append(Action('orphan', 'bilibili', bvid, path, sql, params))
+        return actions
+
+    async def telegram(self) -> list[Action]:
+        cfg = config.telegram
+        files, rows = await asyncio.gather(self.scan(cfg.path), cloudflare.query_d1('SELECT message_id, channel_name FROM telegram;'))
+        by_id = {}
+        for path, ok in files.items():
+            if match := ID_PATTERN.search(Path(path).name):
+                by_id[(Path(path).parent.name, match.group(1))] = (path, ok)
+        actions = []
+        known = {(r['channel_name'], str(r['message_id'])) for r in rows}
+        for key in known:
+            path, ok = by_id.get(key, (None, False))
+            if not ok:
+                sql = 'DELETE FROM telegram WHERE message_id = ?;'
+                actions.append(Action('corrupt' if path else 'missing', 'telegram', key[1], path, sql, (key[1],)))
+        # the channel id is not in the path, so orphans can only be reported
+        actions += [Action('orphan', 'telegram', key[1], path) for key, (path, _) in by_id.items() if key not in known]
+        return actions
+
+    async def tangxin(self) -> list[Action]:
+        cfg = config.tx
+        files, rows = await asyncio.gather(self.scan(cfg.path), cloudflare.query_d1('SELECT id, title, upper, downloaded FROM tx;'))
+        by_name = {Path(path).name: (path, ok) for path, ok in files.items()}
+        actions = []
+        for row in rows:
+            name = f'[{re.sub(INVALID_CHARS, "_", row["upper"])}]{re.sub(INVALID_CHARS, "_", row["title"])}.mp4'
+            item_id = str(row['id'])
+            path, ok = by_name.pop(name, (None, False))
+            if row['downloaded'] and not ok:
+                sql = 'UPDATE tx SET downloaded = 0 WHERE id = ?;'
+                actions.append(Action('corrupt' if path else 'missing', 'tangxin', item_id, path, sql, (item_id,)))
+            elif not row['downloaded'] and ok:
+                actions.append(Action('orphan', 'tangxin', item_id, path, 'UPDATE tx SET downloaded = 1 WHERE id = ?;', (item_id,)))
+        actions += [Action('orphan', 'tangxin', '', path) for path, _ in by_name.values()]
+        return actions
+
+    async def run(self, sources: list[str]) -> list[Action]:
+        """Reconcile the given sources concurrently and return the fix-up actions."""
+        results = await asyncio.gather(*[getattr(self, source)() for source in sources])
+        self.save_index()
+        actions = [a for r in results for a in r]
+        for kind in ('missing', 'corrupt', 'orphan'):
+            log.info('%d %s', sum(a.kind == kind for a in actions), kind)
+        return actions
+
+    @staticmethod
+    async def apply(actions: list[Action]) -> None:
+        """Run the SQL fixes and quarantine broken files so they get downloaded again."""
+        for action in actions:
+            if action.kind == 'corrupt' and action.path and await fs.exists(path := Path(action.path)):
+                # same filesystem as the file, so this is a rename however big it is
+                quarantine = path.parent / QUARANTINE_DIR
+                await fs.mkdir(quarantine)
+                dst_path = await ensure_unique_path(quarantine / path.name)
+                log.warning('Moving broken file %s to %s', path, dst_path)
+                await fs.move(path, dst_path)
+            if action.sql:
+                await cloudflare.query_d1(action.sql, action.params)
+
+
+def dumps(action: Action) -> str:
+    return json.dumps(asdict(action), ensure_ascii=False)
@@ -1,5 +1,51 @@
-from .bilibili import Bilibili
-from .tangxin import Tangxin
-from .telegram import Telegram
+"""Registry of download sources, imported lazily on first use."""
 
-__all__ = ['Bilibili', 'Tangxin', 'Telegram']
+import importlib
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from src.core import logger
+
+log = logger.get('web')
+
+
+@dataclass(frozen=True)
+class Source:
+    name: str
+    module: str
+    attr: str
+    commands: tuple[str, ...] = ()
+
+
+SOURCES = {
+    s.name: s
+    for s in (
+        Source('tangxin', '.tangxin', 'Tangxin', ('ffmpeg',)),
+        Source('bilibili', '.bilibili', 'Bilibili', ('yt-dlp', 'ffmpeg')),
+        Source('telegram', '.telegram', 'Telegram'),
+    )
+}
+import_times: dict[str, float] = {}
+
+
+def load(name: str) -> type:
+    """Import a source module and return its class, recording how long the import took."""
+    source = SOURCES[name]
+    start = time.perf_counter()
+    module = importlib.import_module(source.module, __name__)
+    if name not in import_times:
+        import_times[name] = time.perf_counter() - start
+        log.debug('Imported %s in %.0f ms', name, import_times[name] * 1000)
+    return getattr(module, source.attr)
+
+
+def __getattr__(name: str) -> Any:
+    for source in SOURCES.values():
+        if source.attr == name:
+            return load(source.name)
+    msg = f'module {__name__!r} has no attribute {name!r}'
+    raise AttributeError(msg)
+
+
+__all__ = ['SOURCES', 'Bilibili', 'Tangxin', 'Telegram', 'import_times', 'load']
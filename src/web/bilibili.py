@@ -1,52 +1,80 @@
 """Provides functionality to interact with Bilibili API."""
 
 import asyncio
+import contextlib
 import logging
-import shutil
 import subprocess
 import tempfile
-from collections.abc import Coroutine
+from collections.abc import AsyncIterator, Coroutine
 from http.cookiejar import MozillaCookieJar
 from pathlib import Path
 from typing import Any
 
 import bilibili_api as api
 from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_exponential
-from tqdm import tqdm
 
-from src.core import config, logger
-from src.tool import CookieCloudClient, cloudflare, ensure_unique_path, format_video_filename
+from src.core import config, fs, logger, trace
+from src.core.admission import admission
+from src.core.config import BilibiliAccount
+from src.core.jobs import Job, State, get_queue, run_workers
+from src.core.journal import Journal
+from src.tool import CookieCloudClient, cloudflare, ensure_faststart, ensure_unique_path, format_video_filename, notifier
+from src.tool.lease import Leases
 
 log = logger.get('bilibili')
 cfg = config.bilibili
 
+VIDEO_URL = 'https://www.bilibili.com/video/{}'
+
+# yt-dlp's partial and metadata files, named {bvid}.<ext>.part etc. or {bvid}.part
+PARTIAL_SUFFIXES = frozenset({'.part', '.ytdl', '.tmp', '.json'})
+
 
 class DownloadError(RuntimeError):
     """Raised when a download fails after retries."""
 
 
-class Bilibili:
-    """Class to interact with Bilibili API."""
+class RateLimiter:
+    """Space out the API requests of one account and cap how many are in flight."""
 
-    def __init__(self) -> None:
-        """Initialize Bilibili instance with main and sub credentials."""
-        self._tmp_dir = tempfile.TemporaryDirectory(prefix='fav-bilibili-')
-        self.cache_dir = Path(self._tmp_dir.name)
-        self.cookie_path = self.cache_dir / 'bilibili.txt'
-        self.update_cookie_from_cookiecloud(self.cookie_path)
-        self.credential = self.create_credential(self.cookie_path)
-        self.user = api.user.User(uid=cfg.id, credential=self.credential)
-        self.info_cache = {}
-        log.debug('cache_dir: %s', self.cache_dir)
+    def __init__(self, rate: float, concurrency: int = 5) -> None:
+        self._interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+        self._sem = asyncio.Semaphore(concurrency)
+
+    @contextlib.asynccontextmanager
+    async def __call__(self) -> AsyncIterator[None]:
+        async with self._sem:
+            async with self._lock:
+                now = asyncio.get_running_loop().time()
+                if self._next > now:
+                    await asyncio.sleep(self._next - now)
+                self._next = max(now, self._next) + self._interval
+            yield
 
-    def __del__(self) -> None:
-        self._tmp_dir.cleanup()
 
-    def update_cookie_from_cookiecloud(self, save_path: Path) -> None:
+class Account:
+    """A Bilibili account with its own credential and rate limiter."""
+
+    def __init__(self, acc_cfg: BilibiliAccount, cookie_path: Path) -> None:
+        self.id = acc_cfg.id
+        self.cfg = acc_cfg
+        self.cookie_path = cookie_path
+        self.credential: api.Credential | None = None
+        self.limit = RateLimiter(acc_cfg.rate)
+
+    async def login(self) -> None:
+        """Sync the cookie file from CookieCloud and build the credential from it."""
+        await self.update_cookie_from_cookiecloud(self.cookie_path)
+        self.credential = await fs.run(self.create_credential, self.cookie_path)
+
+    async def update_cookie_from_cookiecloud(self, save_path: Path) -> None:
         """Update cookie from cookiecloud."""
-        cc_cfg = config.cookiecloud
+        cc_cfg = self.cfg.cookiecloud or config.cookiecloud
         client = CookieCloudClient(cc_cfg.server_url, cc_cfg.uuid, cc_cfg.password, proxy=config.proxy if config.proxy else None)
-        client.save_to_netscape_format('bilibili.com', save_path)
+        content = await asyncio.to_thread(client.to_netscape_format, 'bilibili.com')
+        await fs.write_text(save_path, content)
 
     def create_credential(self, cookie_path: Path) -> api.Credential:
         """Create credential from cookie file."""
@@ -60,19 +88,44 @@ class Bilibili:
             log.warning('Some cookies are missing: %s', cookies.keys())
         return api.Credential(**cookies)
 
-    async def check_valid(self, v: api.video.Video) -> bool:
+    def folders(self) -> list[int]:
+        """Favorite list ids of this account, -1 standing for the toview list."""
+        return [*self.cfg.folders, *([-1] if self.cfg.toview else [])]
+
+
+class Bilibili:
+    """Class to interact with Bilibili API."""
+
+    def __init__(self) -> None:
+        """Initialize Bilibili instance with one credential per configured account."""
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='fav-bilibili-')
+        self.cache_dir = Path(self._tmp_dir.name)
+        self.accounts = [Account(a, self.cache_dir / f'bilibili-{a.id}.txt') for a in cfg.accounts]
+        # shared by all accounts and folders, keyed by bvid
+        self.info_cache: dict[str, dict] = {}
+        self.journal = Journal('bilibili')
+        self.journal.gc()
+        self.leases = Leases('bilibili', done='SELECT 1 FROM bilibili WHERE bvid = ?')
+        log.debug('cache_dir: %s', self.cache_dir)
+
+    def __del__(self) -> None:
+        self._tmp_dir.cleanup()
+
+    async def check_valid(self, v: api.video.Video, account: Account) -> bool:
         """Check if the video is valid."""
-        if v in self.info_cache:
+        bvid = v.get_bvid()
+        if bvid in self.info_cache:
             return True
         try:
-            info = await v.get_info()
-            self.info_cache[v] = info
+            async with account.limit():
+                info = await v.get_info()
+            self.info_cache[bvid] = info
         except Exception as e:  # noqa: BLE001
-            log.warning('Video %s is invalid: %s', v.get_bvid(), e)
+            log.warning('Video %s is invalid: %s', bvid, e)
             return False
         # Check if the video is a paid video
         if info['is_upower_exclusive']:
-            log.warning('Video %s is a paid video', v.get_bvid())
+            log.warning('Video %s is a paid video', bvid)
             return False
         return True
 
@@ -85,59 +138,100 @@ class Bilibili:
             await asyncio.sleep(1)
         return results
 
-    async def get_toviews(self) -> list[api.video.Video]:
+    async def get_toviews(self, account: Account) -> list[api.video.Video]:
         """Get the videos in the toview list."""
-        toview = await api.user.get_toview_list(credential=self.credential)
+        async with account.limit():
+            toview = await api.user.get_toview_list(credential=account.credential)
         if not toview['list']:
             return []
         exists_ids = await cloudflare.query_d1('SELECT bvid FROM bilibili WHERE fav_id = -1;')
         exists_ids = [i['bvid'] for i in exists_ids]
-        result = [api.video.Video(bvid=v['bvid'], credential=self.credential) for v in toview['list']]
-        log.info('Find %d toviews in total', len(result))
+        result = [api.video.Video(bvid=v['bvid'], credential=account.credential) for v in toview['list']]
+        log.info('Find %d toviews in total for %s', len(result), account.id)
         for v in result.copy():
             if v.get_bvid() in exists_ids:
                 result.remove(v)
-        log.info('Find %d toviews to download', len(result))
+        log.info('Find %d toviews to download for %s', len(result), account.id)
         if len(result) == 0:
-            log.info('All toviews have been downloaded, clear toview list ...')
-            await api.user.clear_toview_list(credential=self.credential)
+            log.info('All toviews have been downloaded, clear toview list of %s ...', account.id)
+            async with account.limit():
+                await api.user.clear_toview_list(credential=account.credential)
         return result
 
-    async def get_favs(self, fav_id: int) -> list[api.video.Video]:
+    async def get_favs(self, fav_id: int, account: Account) -> list[api.video.Video]:
         """Get the videos in the favorite list."""
         exists_ids = await cloudflare.query_d1('SELECT bvid FROM bilibili WHERE fav_id = ?;', (str(fav_id),))
         exists_ids = [i['bvid'] for i in exists_ids]
-        favlist = api.favorite_list.FavoriteList(media_id=fav_id, credential=self.credential)
+        favlist = api.favorite_list.FavoriteList(media_id=fav_id, credential=account.credential)
         page = 1
         has_more = True
         result = []
         while has_more:
-            res = await favlist.get_content(page=page)
+            async with account.limit():
+                res = await favlist.get_content(page=page)
             has_more = res['has_more']
             page += 1
-            result += [api.video.Video(bvid=media['bvid'], credential=self.credential) for media in res['medias']]
+            result += [api.video.Video(bvid=media['bvid'], credential=account.credential) for media in res['medias']]
             # stop if the last video is already in the database
             if result[-1].get_bvid() in exists_ids:
                 break
-        log.info('Find %d favs in total', len(result))
+        log.info('Find %d favs in total in %d', len(result), fav_id)
         for video in result.copy():
             if video.get_bvid() in exists_ids:
                 result.remove(video)
-        log.info('Find %d favs to download', len(result))
+        log.info('Find %d favs to download in %d', len(result), fav_id)
         return result
 
-    def _cleanup_dir(self, dirpath: Path) -> None:
-        """Clear out temporary download directory."""
-        if not dirpath.exists():
-            return
-        for entry in dirpath.iterdir():
-            if entry.is_dir():
-                shutil.rmtree(entry)
-            else:
-                entry.unlink()
-
-    def download(self, url: str, bvid: str, dirpath: Path, max_attempts: int = 3, base_delay: int = 5) -> None:
-        """Download a video from Bilibili with retries."""
+    async def list_folder(self, account: Account, fav_id: int) -> list[api.video.Video]:
+        """List the valid, not yet downloaded videos of one folder, oldest first."""
+        with trace.lane('bilibili', f'fav {fav_id}'):
+            with trace.span('list'):
+                # for toview
+                videos = await self.get_toviews(account) if fav_id == -1 else await self.get_favs(fav_id, account)
+            with trace.span('check_valid', videos=len(videos)):
+                valid = await asyncio.gather(*[self.check_valid(v, account) for v in videos])
+        return [v for v, vld in zip(videos, valid, strict=True) if vld][::-1]
+
+    async def discover(self, fav_ids: list[int] | None = None) -> list[tuple[api.video.Video, int, Account]]:
+        """Scan every folder of every account concurrently and build one deduplicated queue.
+
+        Returns:
+            list of (video, fav_id, account) in download order
+
+        """
+        targets = [(a, f) for a in self.accounts for f in a.folders() if not fav_ids or f in fav_ids]
+        with trace.lane('bilibili'), trace.span('d1'):
+            downloaded = {r['bvid'] for r in await cloudflare.query_d1('SELECT bvid FROM bilibili;')}
+        lists = await asyncio.gather(*[self.list_folder(account, fav_id) for account, fav_id in targets])
+        queue = []
+        seen = set(downloaded)
+        for (account, fav_id), videos in zip(targets, lists, strict=True):
+            for video in videos:
+                if video.get_bvid() in seen:
+                    continue
+                seen.add(video.get_bvid())
+                queue.append((video, fav_id, account))
+        log.info('Found %d new videos in %d folders', len(queue), len(targets))
+        return queue
+
+    async def estimate_size(self, v: api.video.Video) -> int:
+        """Estimate the size of the best DASH video and audio streams from their bandwidth and duration."""
+        try:
+            data = await v.get_download_url(page_index=0)
+        except Exception as e:  # noqa: BLE001
+            log.warning('Could not estimate the size of %s: %s', v.get_bvid(), e)
+            return 0
+        dash = data.get('dash')
+        if not dash:
+            return sum(d.get('size', 0) for d in data.get('durl', []))
+        duration = dash.get('duration', 0)
+        video_bw = max((s.get('bandwidth', 0) for s in dash.get('video') or []), default=0)
+        audio_bw = max((s.get('bandwidth', 0) for s in dash.get('audio') or []), default=0)
+        return (video_bw + audio_bw) * duration // 8
+
+    def download(self, bvid: str, dirpath: Path, account: Account, *, max_attempts: int = 3, base_delay: int = 5) -> None:
+        """Download a video from Bilibili with retries, resuming partial files left in `dirpath`."""
+        url = VIDEO_URL.format(bvid)
         log.info('Downloading %s', url)
         # Use simple filename template with just the video ID, we'll rename it properly later
         command = [
@@ -145,8 +239,9 @@ class Bilibili:
             '-o',
             str(dirpath / f'{bvid}.%(ext)s'),
             '--no-mtime',
+            '--continue',
             '--cookies',
-            str(self.cookie_path),
+            str(account.cookie_path),
             '--retries',
             '15',
             '--fragment-retries',
@@ -166,7 +261,6 @@ class Bilibili:
             before_sleep=before_sleep_log(log, logging.WARNING),
         )
         def _run_once() -> None:
-            self._cleanup_dir(dirpath)
             result = subprocess.run(command, text=True, capture_output=True, check=False)  # noqa: S603
             if result.returncode == 0:
                 if result.stderr:
@@ -178,28 +272,38 @@ class Bilibili:
 
         _run_once()
 
-    async def update_fav(self, fav_id: int, path: Path) -> None:
-        path.mkdir(parents=True,exist_ok=True)
-        # for toview
-        if fav_id == -1:
-            videos = await self.get_toviews()
-        else:
-            videos = await self.get_favs(fav_id)
-        if not videos:
-            log.info('No new videos')
-            return
-        valid = await asyncio.gather(*[self.check_valid(v) for v in videos])
-        videos = [v for v, vld in zip(videos, valid, strict=True) if vld]
-        for video in tqdm(videos[::-1], desc='Scanning bilibili'):
-            bvid = video.get_bvid()
-            detail = await video.get_detail()
-            title = detail['View']['title']
-            upper = detail['Card']['card']['name']
-            url = f'https://www.bilibili.com/video/{bvid}'
-            video_cache_dir = self.cache_dir / 'videos'
-            video_cache_dir.mkdir(exist_ok=True)
-            self.download(url, bvid, video_cache_dir)
-            for v in video_cache_dir.iterdir():
+    async def download_video(self, video: api.video.Video, fav_id: int, account: Account, job: Job) -> None:
+        """Download one video into the folder's library dir and record it in D1."""
+        bvid = video.get_bvid()
+        path = cfg.path / ('toview' if fav_id == -1 else 'fav')
+        await fs.mkdir(path)
+        with trace.span('detail'):
+            async with account.limit():
+                detail = await video.get_detail()
+        title = detail['View']['title']
+        upper = detail['Card']['card']['name']
+        url = VIDEO_URL.format(bvid)
+        # per-video scratch dir survives crashes so yt-dlp can --continue the partial file
+        video_cache_dir = await self.journal.ascratch(bvid)
+        await self.journal.asave(bvid, {'url': url, 'fav_id': fav_id})
+        with trace.span('estimate'):
+            async with account.limit():
+                size = await self.estimate_size(video)
+        # separate video and audio streams plus the merged file in scratch, then the library copy
+        scratch_factor = 3 if config.faststart else 2
+        with trace.span('admission', size=size):
+            reservation = await admission.reserve({video_cache_dir: size * scratch_factor, path: size}, bvid)
+        try:
+            with trace.span('fetch'):
+                await asyncio.to_thread(self.download, bvid, video_cache_dir, account)
+            get_queue().set_state(job, State.MERGING)
+            dst_paths = []
+            # only yt-dlp's final {bvid}.<ext>, not its intermediates or leftovers of an interrupted run
+            outputs = [v for v in await fs.iterdir(video_cache_dir) if v.stem == bvid and v.suffix not in PARTIAL_SUFFIXES]
+            if not outputs:
+                msg = f'yt-dlp left no output for {bvid}'
+                raise DownloadError(msg)
+            for v in outputs:
                 # Format the proper filename with sanitized title and uploader
                 proper_filename = format_video_filename(
                     title=title,
@@ -208,15 +312,33 @@ class Bilibili:
                     ext=v.suffix,
                 )
                 dst_path = path / proper_filename
-                dst_path = ensure_unique_path(dst_path)
-                shutil.move(v, dst_path)
+                dst_path = await ensure_unique_path(dst_path)
+                with trace.span('faststart'):
+                    await ensure_faststart(v)
+                with trace.span('move'):
+                    await fs.move(v, dst_path)
+                dst_paths.append(dst_path)
+        finally:
+            await reservation.release()
+        get_queue().set_state(job, State.COMMITTING)
+        with trace.span('commit'):
+            # idempotent, so a 5xx after the download is retried instead of losing the record
             await cloudflare.query_d1(
-                'INSERT INTO bilibili (bvid, fav_id, title, upper) VALUES (?, ?, ?, ?);',
+                'INSERT INTO bilibili (bvid, fav_id, title, upper) VALUES (?, ?, ?, ?) ON CONFLICT (bvid) DO NOTHING;',
                 (bvid, str(fav_id), title, upper),
             )
+        for dst_path in dst_paths:
+            await notifier.added(dst_path, source='bilibili', video_id=bvid, title=title, uploader=upper)
+        await self.journal.afinish(bvid)
+        get_queue().done(job)
 
-    async def update(self) -> None:
-        """Update the favorite list of the main account."""
+    async def update(self, fav_ids: list[int] | None = None) -> None:
+        """Update the favorite lists of all configured accounts.
+
+        Args:
+            fav_ids: only update these favorite lists (-1 for toview), defaults to every configured folder
+
+        """
         # Initialize table
         await cloudflare.query_d1("""
             CREATE TABLE IF NOT EXISTS bilibili (
@@ -227,7 +349,33 @@ class Bilibili:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
         """)
+        await self.leases.init()
         log.debug('bilibili table initialized')
-        
-        await self.update_fav(cfg.fav_id, cfg.path / 'fav')
-        await self.update_fav(-1, cfg.path / 'toview')
+        await asyncio.gather(*[a.login() for a in self.accounts])
+
+        queue = await self.discover(fav_ids)
+        if not queue:
+            log.info('No new videos')
+        get_queue().put_many('bilibili', [(v.get_bvid(), {'fav_id': fav_id, 'account': account.id}, 0) for v, fav_id, account in queue])
+        accounts = {a.id: a for a in self.accounts}
+
+        async def handle(job: Job) -> None:
+            account = accounts.get(job.payload['account'])
+            if account is None:
+                msg = f'Account {job.payload["account"]} is not configured'
+                raise ValueError(msg)
+            if not await self.leases.claim(job.key):
+                get_queue().drop(job)
+                return
+            try:
+                with trace.lane('bilibili', job.key):
+                    video = api.video.Video(bvid=job.key, credential=account.credential)
+                    await self.download_video(video, job.payload['fav_id'], account, job)
+            finally:
+                await self.leases.release(job.key)
+
+        try:
+            await run_workers('bilibili', handle, cfg.workers, only={'fav_id': fav_ids} if fav_ids else None)
+        finally:
+            await self.leases.close()
+            await fs.run(self._tmp_dir.cleanup)
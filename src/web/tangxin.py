@@ -1,21 +1,38 @@
 import asyncio
+import logging
 import re
-import shutil
-import tempfile
+import statistics
+import time
 from pathlib import Path
 
 import httpx
 from Crypto.Cipher import AES
 from pydantic import BaseModel
-from tqdm import tqdm
+from tenacity import AsyncRetrying, before_sleep_log, retry_if_exception, stop_after_attempt, wait_random_exponential
 
-from src.core import config, logger
-from src.tool import cloudflare
+from src.core import config, fs, logger, progress, trace
+from src.core.admission import Reservation, admission
+from src.core.concurrency import AdaptiveConcurrency
+from src.core.jobs import Job, State, get_queue, run_workers
+from src.core.journal import Journal
+from src.tool import cloudflare, ensure_faststart, notifier
+from src.tool.lease import Leases
 
 log = logger.get('tangxin')
 cfg = config.tx
 cf_cfg = config.cloudflare
 
+KEY_PATTERN = re.compile(r'#EXT-X-KEY:METHOD=AES-128,URI="(http.+)",IV=(.+)')
+PREFETCH_CONCURRENCY = 10
+SEGMENT_RETRIES = 5
+# a segment is hedged once it has run this long at under 1/HEDGE_SLOWDOWN of the item's median throughput
+HEDGE_MIN_AGE = 5.0
+HEDGE_SLOWDOWN = 4
+HEDGE_MIN_SAMPLES = 5
+HEDGE_CHECK_INTERVAL = 1.0
+# network chunks are only a few KiB, hand them to the fs pool in larger writes
+WRITE_BUFFER = 1024**2
+
 
 class Item(BaseModel):
     id: int
@@ -24,8 +41,80 @@ class Item(BaseModel):
     urls: list[str] | None = None
     key: bytes | None = None
     iv: bytes | None = None
-    part_sizes: list[int] = []
     banner: str | None = None
+    expiration: int | None = None
+    segment_times: list[float] = []
+    segment_rates: list[float] = []
+    hedges: int = 0
+    hedge_wins: int = 0
+    hedge_saved: float = 0
+
+
+class Transfer:
+    """Progress of one request for a segment, written to `path` from byte `base` of the segment."""
+
+    def __init__(self, path: Path, base: int = 0, *, hedge: bool = False) -> None:
+        self.path = path
+        self.base = base
+        self.hedge = hedge
+        self.size: int | None = None
+        self.pos = base
+        self.received = 0
+        self.started: float | None = None
+
+    def begin(self, offset: int, length: int, tracker: progress.Tracker | None) -> None:
+        """Start an attempt that continues `offset` bytes into the file with `length` more bytes."""
+        self.pos = self.base + offset
+        self.received = 0
+        self.started = time.monotonic()
+        if self.size is None:
+            self.size = self.pos + length
+            if tracker:
+                tracker.add_part(self.size)
+                tracker.update(offset)
+
+    def rate(self) -> float:
+        """Throughput of the current attempt in bytes per second."""
+        if self.started is None:
+            return 0
+        return self.received / max(time.monotonic() - self.started, 1e-3)
+
+
+def _splice(part_path: Path, hedge_path: Path, base: int) -> bool:
+    """Replace everything after `base` in the primary's file with the hedge's bytes.
+
+    Returns False and discards the hedge if the primary's file no longer reaches `base`,
+    e.g. because a retry started it over, as splicing would leave a hole.
+    """
+    with part_path.open('r+b') as f:
+        if f.seek(0, 2) < base:
+            hedge_path.unlink()
+            return False
+        f.seek(base)
+        f.truncate()
+        f.write(hedge_path.read_bytes())
+    hedge_path.unlink()
+    return True
+
+
+def _decrypt(part_path: Path, ts_path: Path, key: bytes, iv: bytes) -> None:
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    tmp_path = ts_path.with_suffix('.tmp')
+    tmp_path.write_bytes(cipher.decrypt(part_path.read_bytes()))
+    tmp_path.replace(ts_path)
+    part_path.unlink()
+
+
+def _complete_size(res: httpx.Response) -> int | None:
+    """Full size of the resource from the `Content-Range: bytes */N` of a 416 response."""
+    match = re.fullmatch(r'bytes \*/(\d+)', res.headers.get('content-range', ''))
+    return int(match.group(1)) if match else None
+
+
+def _retryable(e: BaseException) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in cloudflare.RETRY_STATUS
+    return isinstance(e, httpx.TransportError)
 
 
 class Tangxin:
@@ -36,74 +125,337 @@ class Tangxin:
                 'Origin': cfg.host,
             },
             timeout=60,
-            limits=httpx.Limits(max_keepalive_connections=10, max_connections=10),
+            # the adaptive controller decides how many segments are fetched at once
+            limits=httpx.Limits(max_keepalive_connections=cfg.max_segment_concurrency, max_connections=cfg.max_segment_concurrency),
             proxy=config.proxy if config.proxy else None,
         )
+        self.journal = Journal('tangxin')
+        self.journal.gc(legacy_prefix='fav-tangxin-')
+        self._keys: dict[str, asyncio.Task[bytes]] = {}
+        self.leases = Leases('tangxin', table='tx', pending='downloaded = 0')
+        self.concurrency = AdaptiveConcurrency(cfg.segment_concurrency, max_limit=cfg.max_segment_concurrency)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedge_saved = 0.0
 
     async def get_items(self) -> list[Item]:
-        results = await cloudflare.query_d1('SELECT id, title, upper FROM tx WHERE downloaded = 0 ORDER BY created_at ASC;')
+        with trace.span('d1'):
+            results = await cloudflare.query_d1(
+                f'SELECT id, title, upper FROM tx WHERE downloaded = 0 AND {self.leases.available()} ORDER BY created_at ASC;',  # noqa: S608
+            )
         for i in results:
             i['title'] = re.sub(r'[<>:"/\\|?*]', '_', i['title'])
             i['upper'] = re.sub(r'[<>:"/\\|?*]', '_', i['upper'])
         return [Item.model_validate(i) for i in results]
 
-    async def download(self, item: Item) -> asyncio.Task:
+    def get_key(self, key_url: str) -> asyncio.Task[bytes]:
+        """Fetch an AES key once per URL, sharing the in-flight request between items."""
+        task = self._keys.get(key_url)
+        if task is None or (task.done() and (task.cancelled() or task.exception())):
+
+            async def _fetch() -> bytes:
+                res = await self.client.get(key_url)
+                res.raise_for_status()
+                return res.content
+
+            self._keys[key_url] = asyncio.create_task(_fetch())
+        return self._keys[key_url]
+
+    async def prefetch(self, items: list[Item]) -> list[Item]:
+        """Cache all pending playlists and keys up front.
+
+        Items whose playlist is no longer in KV are reported and dropped.
+        """
+        kv_id = cf_cfg.kv_id['tangxin']
+        expirations = {k['name']: k.get('expiration') for k in await cloudflare.list_kv_keys(kv_id)}
+        ready, to_fetch = [], []
+        for item in items:
+            if await fs.exists(await self.journal.ascratch(item.id) / 'playlist.m3u8'):
+                ready.append(item)
+            elif str(item.id) in expirations:
+                item.expiration = expirations[str(item.id)]
+                to_fetch.append(item)
+            else:
+                log.error('Playlist of %s %s has expired, open the page again to refresh it', item.id, item.title)
+                await self.journal.afinish(item.id)
+
+        sem = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+        async def _fetch(item: Item) -> bool:
+            async with sem:
+                try:
+                    m3u8 = (await cloudflare.get_kv(kv_id, item.id)).text
+                except ValueError:
+                    log.error('Failed to prefetch playlist of %s %s', item.id, item.title)  # noqa: TRY400
+                    return False
+            await fs.write_text(await self.journal.ascratch(item.id) / 'playlist.m3u8', m3u8)
+            return True
+
+        fetched = await asyncio.gather(*[_fetch(i) for i in to_fetch])
+        ready += [i for i, ok in zip(to_fetch, fetched, strict=True) if ok]
+        log.info('Prefetched %d playlists, %d items ready', sum(fetched), len(ready))
+
+        # warm the key cache, each distinct key URL is requested once
+        for item in ready:
+            match = KEY_PATTERN.search(await fs.read_text(await self.journal.ascratch(item.id) / 'playlist.m3u8'))
+            if match:
+                self.get_key(match.group(1))
+
+        return ready
+
+    async def estimate_size(self, item: Item, samples: int = 3) -> int:
+        """Estimate the video size from the segment count and a few sampled content-lengths."""
+        step = max(1, len(item.urls) // samples)
+        sizes = []
+        for url in item.urls[::step][:samples]:
+            try:
+                res = await self.client.head(url)
+            except httpx.HTTPError:
+                continue
+            if size := int(res.headers.get('content-length', 0)):
+                sizes.append(size)
+        if not sizes:
+            log.warning('Could not estimate the size of %s', item.banner)
+            return 0
+        return sum(sizes) * len(item.urls) // len(sizes)
+
+    async def download(self, item: Item, job: Job) -> asyncio.Task:
         dst_path = cfg.path / f'[{item.upper}]{item.title}.mp4'
-        if dst_path.exists():
+        if await fs.exists(dst_path):
             log.error('File already exists %s for %s', dst_path.name, item.id)
             msg = 'File already exists'
             raise ValueError(msg)
-        m3u8 = (await cloudflare.get_kv(cf_cfg.kv_id['tangxin'], item.id)).text
-        key_url, iv = re.search(r'#EXT-X-KEY:METHOD=AES-128,URI="(http.+)",IV=(.+)', m3u8).groups()
-        key_res = await self.client.get(key_url)
-        key_res.raise_for_status()
-        item.key = key_res.content
+        tmp_dir_path = await self.journal.ascratch(item.id)
+        state = await self.journal.aload(item.id)
+        # the playlist expires in KV, so keep a copy next to the segments for resuming
+        playlist_path = tmp_dir_path / 'playlist.m3u8'
+        if await fs.exists(playlist_path):
+            m3u8 = await fs.read_text(playlist_path)
+        else:
+            if item.expiration is not None and item.expiration < time.time():
+                msg = f'Playlist of {item.id} has expired'
+                raise ValueError(msg)
+            with trace.span('kv'):
+                m3u8 = (await cloudflare.get_kv(cf_cfg.kv_id['tangxin'], item.id)).text
+            await fs.write_text(playlist_path, m3u8)
+        key_url, iv = KEY_PATTERN.search(m3u8).groups()
+        with trace.span('key'):
+            item.key = bytes.fromhex(state['key']) if 'key' in state else await self.get_key(key_url)
         item.iv = bytes.fromhex(iv.replace('0x', ''))
         item.urls = re.findall(r'https:.+.ts.+', m3u8)
-        tmp_dir = tempfile.TemporaryDirectory(prefix='fav-tangxin-', delete=False)
-        tmp_dir_path = Path(tmp_dir.name)
-        with tqdm(total=0, unit='B', unit_scale=True, desc=item.title, dynamic_ncols=True) as pbar:
-            tasks = [self.download_part(item, tmp_dir_path, index, pbar) for index in range(len(item.urls))]
-            await asyncio.gather(*tasks)
-
-        async def merge_task() -> None:
-            log.info('Merging %s', item.banner)
-            tmp_txt_path = tmp_dir_path / 'merge.txt'
-            tmp_mp4_path = tmp_dir_path / 'merged.mp4'
-            with tmp_txt_path.open('w') as f:
-                for i in range(len(item.urls)):
-                    f.write(f'file {tmp_dir_path / f"{i}.ts"}\n')
-            cmd = f'ffmpeg -hide_banner -loglevel warning -f concat -safe 0 -i "{tmp_txt_path}" -c copy -y "{tmp_mp4_path}"'
+        state['key'] = item.key.hex()
+        state['segments'] = [i for i in state.get('segments', []) if await fs.exists(tmp_dir_path / f'{i}.ts')]
+        await self.journal.asave(item.id, state)
+        if state['segments']:
+            log.info('Resuming %s with %d/%d segments done', item.banner, len(state['segments']), len(item.urls))
+        with trace.span('estimate'):
+            size = await self.estimate_size(item)
+        # .ts segments plus merged.mp4 in scratch, then the library copy
+        scratch_factor = 3 if config.faststart else 2
+        with trace.span('admission', size=size):
+            reservation = await admission.reserve({tmp_dir_path: size * scratch_factor, cfg.path: size}, item.banner)
+        try:
+            await self.fetch(item, tmp_dir_path, state)
+        except BaseException:
+            await reservation.release()
+            raise
+        return asyncio.create_task(self.merge_task(item, job, tmp_dir_path, dst_path, reservation))
+
+    async def fetch(self, item: Item, tmp_dir_path: Path, state: dict) -> None:
+        """Fetch the segments that are not done yet and account the item's hedges."""
+        tracker = progress.track('tangxin', item.id, item.title, parts=len(item.urls))
+        for i in state['segments']:
+            ts_size = await fs.size(tmp_dir_path / f'{i}.ts')
+            tracker.add_part(ts_size)
+            tracker.update(ts_size)
+        done = set(state['segments'])
+        tasks = [
+            asyncio.create_task(self.download_part(item, tmp_dir_path, index, tracker, state))
+            for index in range(len(item.urls))
+            if index not in done
+        ]
+        try:
+            with trace.span('fetch', segments=len(tasks)) as fetch_span:
+                await asyncio.gather(*tasks)
+                stats = self.record_fetch(item)
+                if fetch_span is not None:
+                    fetch_span.args.update(stats)
+        finally:
+            # a failed segment fails the item, stop the others before its lease and space are released
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            tracker.close()
+
+    async def merge_task(self, item: Item, job: Job, tmp_dir_path: Path, dst_path: Path, reservation: Reservation) -> None:
+        """Merge and commit a fetched item in the background, failing its job on errors."""
+        try:
+            await self.merge(item, job, tmp_dir_path, dst_path)
+        except Exception as e:  # noqa: BLE001
+            get_queue().fail(job, str(e) or type(e).__name__)
+        finally:
+            await reservation.release()
+            await self.leases.release(item.id)
+
+    async def merge(self, item: Item, job: Job, tmp_dir_path: Path, dst_path: Path) -> None:
+        """Merge the fetched segments, move the video to the library and commit it."""
+        queue = get_queue()
+        queue.set_state(job, State.MERGING)
+        log.info('Merging %s', item.banner)
+        tmp_txt_path = tmp_dir_path / 'merge.txt'
+        tmp_mp4_path = tmp_dir_path / 'merged.mp4'
+        await fs.write_text(tmp_txt_path, ''.join(f'file {tmp_dir_path / f"{i}.ts"}\n' for i in range(len(item.urls))))
+        cmd = f'ffmpeg -hide_banner -loglevel warning -f concat -safe 0 -i "{tmp_txt_path}" -c copy -y "{tmp_mp4_path}"'
+        with trace.span('merge'):
             proc = await asyncio.create_subprocess_shell(cmd)
             stdout, stderr = await proc.communicate()
-            log.info('Finished merge %s', item.banner)
-            if proc.returncode != 0:
-                msg = f'Failed to merge {item.id} {item.title}'
-                raise ValueError(msg)
-            if stdout:
-                log.info('[stdout]\n%s', stdout.decode())
-            if stderr:
-                log.error('[stderr]\n%s', stderr.decode())
+        log.info('Finished merge %s', item.banner)
+        if proc.returncode != 0:
+            msg = f'Failed to merge {item.id} {item.title}'
+            raise ValueError(msg)
+        if stdout:
+            log.info('[stdout]\n%s', stdout.decode())
+        if stderr:
+            log.error('[stderr]\n%s', stderr.decode())
 
-            shutil.move(tmp_mp4_path, dst_path)
+        with trace.span('faststart'):
+            await ensure_faststart(tmp_mp4_path)
+        with trace.span('move'):
+            await fs.move(tmp_mp4_path, dst_path)
+        queue.set_state(job, State.COMMITTING)
+        with trace.span('commit'):
             await cloudflare.query_d1('UPDATE tx SET downloaded = 1 WHERE id = ?;', (str(item.id),))
-            tmp_dir.cleanup()
-            log.notice('Finished %s', item.banner)
-
-        return asyncio.create_task(merge_task())
-
-    async def download_part(self, item: Item, dir_path: Path, index: int, pbar: tqdm) -> None:
-        encrypt_content = b''
-        async with self.client.stream('GET', item.urls[index]) as res:
-            file_size = int(res.headers.get('content-length', 0))
-            item.part_sizes.append(file_size)
-            pbar.total = sum(item.part_sizes) / len(item.part_sizes) * len(item.urls)
-            async for chunk in res.aiter_bytes():
-                encrypt_content += chunk
-                pbar.update(len(chunk))
-        cipher = AES.new(item.key, AES.MODE_CBC, item.iv)
-        content = cipher.decrypt(encrypt_content)
-        (dir_path / f'{index}.ts').write_bytes(content)
+        await notifier.added(dst_path, source='tangxin', video_id=item.id, title=item.title, uploader=item.upper)
+        await self.journal.afinish(item.id)
+        queue.done(job)
+        log.notice('Finished %s', item.banner)
+
+    def record_fetch(self, item: Item) -> dict[str, float]:
+        """Add an item's hedge counts to the run totals and summarise its fetch for the trace."""
+        if item.hedges:
+            log.info('%s: hedged %d segments, %d hedges won, ~%.1fs saved', item.banner, item.hedges, item.hedge_wins, item.hedge_saved)
+        self.hedges += item.hedges
+        self.hedge_wins += item.hedge_wins
+        self.hedge_saved += item.hedge_saved
+        stats = {'hedges': item.hedges, 'hedge_wins': item.hedge_wins, 'hedge_saved': round(item.hedge_saved, 1)}
+        if item.segment_times:
+            # per-segment spans would overlap on one row, so summarise the tail instead
+            times = sorted(item.segment_times)
+            stats.update(p50=times[len(times) // 2], p99=times[len(times) * 99 // 100], max=times[-1])
+        return stats
+
+    async def download_part(self, item: Item, dir_path: Path, index: int, tracker: progress.Tracker, state: dict) -> None:
+        # encrypted bytes are streamed to a .part file so an interrupted segment resumes with a Range request
+        url = item.urls[index]
+        part_path = dir_path / f'{index}.part'
+        hedge_path = dir_path / f'{index}.hedge'
+        start = time.monotonic()
+        primary = Transfer(part_path)
+        hedge = None
+        tasks = {asyncio.create_task(self.fetch_segment(url, primary, tracker)): primary}
+        try:
+            winner = None
+            while winner is None:
+                done, _ = await asyncio.wait(tasks, timeout=HEDGE_CHECK_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    transfer = tasks.pop(task)
+                    if task.exception() is None:
+                        winner = transfer
+                        break
+                    if not tasks:
+                        raise task.exception()
+                    log.warning('Segment %d of %s failed, waiting for the other request: %s', index, item.banner, task.exception())
+                if winner is None and hedge is None and self.is_straggler(item, primary):
+                    # the hedge picks up where the primary is, whichever reaches the end first wins
+                    await fs.unlink(hedge_path, missing_ok=True)
+                    hedge = Transfer(hedge_path, base=primary.pos, hedge=True)
+                    tasks[asyncio.create_task(self.fetch_segment(url, hedge))] = hedge
+                    item.hedges += 1
+                    log.debug('Hedging segment %d of %s at %d/%d bytes', index, item.banner, primary.pos, primary.size)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if winner is hedge:
+            if await fs.run(_splice, part_path, hedge_path, hedge.base):
+                rate = primary.rate()
+                item.hedge_wins += 1
+                item.hedge_saved += (primary.size - primary.pos) / rate if rate else 0
+                tracker.update(primary.size - primary.pos)
+            else:
+                log.warning('Segment %d of %s was restarted behind its hedge, fetching the rest again', index, item.banner)
+                winner = primary
+                await self.fetch_segment(url, primary, tracker)
+        elif hedge is not None:
+            await fs.unlink(hedge_path, missing_ok=True)
+        item.segment_rates.append(winner.rate())
+        await fs.run(_decrypt, part_path, dir_path / f'{index}.ts', item.key, item.iv)
+        item.segment_times.append(time.monotonic() - start)
+        state['segments'].append(index)
+        await self.journal.asave(item.id, state)
+
+    @staticmethod
+    def is_straggler(item: Item, transfer: Transfer) -> bool:
+        """Whether a segment request has fallen well behind the item's median throughput."""
+        if transfer.started is None or transfer.size is None or len(item.segment_rates) < HEDGE_MIN_SAMPLES:
+            return False
+        if time.monotonic() - transfer.started < HEDGE_MIN_AGE:
+            return False
+        return transfer.rate() < statistics.median(item.segment_rates) / HEDGE_SLOWDOWN
+
+    async def fetch_segment(self, url: str, transfer: Transfer, tracker: progress.Tracker | None = None) -> None:
+        """Fetch a segment into `transfer.path`, retrying transient errors and resuming with Range."""
+        retrying = AsyncRetrying(
+            stop=stop_after_attempt(SEGMENT_RETRIES),
+            wait=wait_random_exponential(multiplier=1, max=30),
+            retry=retry_if_exception(_retryable),
+            before_sleep=before_sleep_log(log, logging.WARNING),
+            reraise=True,
+        )
+        await retrying(self._fetch_segment_once, url, transfer, tracker)
+
+    async def _fetch_segment_once(self, url: str, transfer: Transfer, tracker: progress.Tracker | None) -> None:
+        offset = await fs.size(transfer.path)
+        headers = {'Range': f'bytes={transfer.base + offset}-'} if transfer.base + offset else None
+        slot = self.concurrency.slot(httpx.URL(url).host, wait=not transfer.hedge)
+        async with slot as sample, self.client.stream('GET', url, headers=headers) as res:
+            if headers and res.status_code == httpx.codes.REQUESTED_RANGE_NOT_SATISFIABLE and _complete_size(res) == transfer.base + offset:
+                # fully fetched before a crash, only the decryption was left
+                transfer.begin(offset, 0, tracker)
+                return
+            res.raise_for_status()
+            if headers and res.status_code != httpx.codes.PARTIAL_CONTENT:
+                if transfer.hedge:
+                    msg = f'{httpx.URL(url).host} ignored the Range request'
+                    raise ValueError(msg)
+                # the server sent the whole segment, start the file over
+                if tracker and transfer.size is not None:
+                    tracker.update(-offset)
+                offset = 0
+            transfer.begin(offset, int(res.headers.get('content-length', 0)), tracker)
+            f = await fs.run(transfer.path.open, 'ab' if offset else 'wb')
+            buffer = bytearray()
+
+            async def flush() -> None:
+                nonlocal buffer
+                data, buffer = buffer, bytearray()
+                await fs.run(f.write, data)
+                transfer.pos += len(data)
+
+            try:
+                async for chunk in res.aiter_bytes():
+                    buffer += chunk
+                    transfer.received += len(chunk)
+                    sample.add(len(chunk))
+                    if tracker:
+                        tracker.update(len(chunk))
+                    if len(buffer) >= WRITE_BUFFER:
+                        await flush()
+            finally:
+                # also on errors, so a retry resumes after everything received
+                if buffer:
+                    await flush()
+                await fs.run(f.close)
 
     async def update(self) -> None:
         # Initialize table
@@ -116,19 +468,46 @@ class Tangxin:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
         """)
+        await self.leases.init()
         log.debug('tx table initialized')
         
-        items = await self.get_items()
-        if not items:
-            log.info('No new content')
-            return
-        log.info('Found %d new content', len(items))
+        with trace.lane('tangxin'):
+            items = await self.get_items()
+            if items:
+                log.info('Found %d new content', len(items))
+                with trace.span('prefetch', items=len(items)):
+                    items = await self.prefetch(items)
+            else:
+                log.info('No new content')
+        # closest to playlist expiry first, locally cached playlists (no expiry) last
+        get_queue().put_many(
+            'tangxin',
+            [(i.id, i.model_dump(include={'id', 'title', 'upper', 'expiration'}), -(i.expiration or 2**62)) for i in items],
+        )
         merge_tasks = []
-        for idx, i in enumerate(items):
-            i.banner = f'[{idx + 1}/{len(items)}] {i.id} {i.title}'
-            log.info('Start %s', i.banner)
-            merge_task = await self.download(i)
-            merge_tasks.append(merge_task)
-
-        # Wait for all merging tasks to complete
-        await asyncio.gather(*merge_tasks)
+
+        async def handle(job: Job) -> None:
+            item = Item.model_validate(job.payload)
+            item.banner = f'{item.id} {item.title}'
+            # another worker may have taken it since the listing
+            if not await self.leases.claim(item.id):
+                get_queue().drop(job)
+                return
+            log.info('Start %s', item.banner)
+            # the merge task copies this context, so its spans land on the item's row too
+            with trace.lane('tangxin', item.id):
+                try:
+                    merge_tasks.append(await self.download(item, job))
+                except BaseException:
+                    await self.leases.release(item.id)
+                    raise
+
+        try:
+            # merging runs in the background, so the next download starts while the previous one is merged
+            await run_workers('tangxin', handle, cfg.workers)
+            await asyncio.gather(*merge_tasks)
+        finally:
+            if self.hedges:
+                log.info('Hedged %d segments, %d hedges won, ~%.1fs saved', self.hedges, self.hedge_wins, self.hedge_saved)
+            self.concurrency.save()
+            await self.leases.close()
@@ -1,27 +1,42 @@
-import shutil
-import tempfile
 from collections import defaultdict
 from pathlib import Path
+from typing import BinaryIO
 
 from telethon import TelegramClient
 from telethon.tl.types import Channel, DocumentAttributeVideo, Message, PeerChannel
-from tqdm import tqdm
 
-from src.core import config, logger
-from src.tool import cloudflare, format_video_filename, sanitize
+from src.core import config, fs, logger, progress, trace
+from src.core.admission import admission
+from src.core.jobs import Job, State, get_queue, run_workers
+from src.core.journal import Journal
+from src.tool import cloudflare, ensure_faststart, format_video_filename, notifier, sanitize
+from src.tool.lease import Leases
 
 log = logger.get('telegram')
 cfg = config.telegram
 
+# Telegram requires offsets aligned to the request size when resuming a download
+CHUNK_SIZE = 512 * 1024
+# persist the offset every few chunks rather than on each one
+SAVE_EVERY = 16 * CHUNK_SIZE
+
+
+def _open_at(path: Path, offset: int) -> BinaryIO:
+    """Open a partial download for writing from `offset`, dropping anything after it."""
+    f = path.open('r+b' if path.exists() else 'wb')
+    f.seek(offset)
+    f.truncate()
+    return f
+
 
 class Telegram:
     def __init__(self) -> None:
-        self._tmp_dir = tempfile.TemporaryDirectory(prefix='fav-telegram-')
-        self.cache_dir = Path(self._tmp_dir.name)
+        self.journal = Journal('telegram')
+        self.journal.gc(legacy_prefix='fav-telegram-')
+        self.leases = Leases('telegram', done='SELECT 1 FROM telegram WHERE message_id = ?')
         self.client = TelegramClient(cfg.session_path, cfg.api_id, cfg.api_hash)
-
-    def __del__(self) -> None:
-        self._tmp_dir.cleanup()
+        # messages seen during discovery, so queued jobs need not fetch them again
+        self.messages: dict[int, Message] = {}
 
     @staticmethod
     async def get_downloaded_ids(channel_id: int) -> list[int]:
@@ -114,72 +129,149 @@ class Telegram:
         
         return result
 
-    async def download(self, msg: Message, dst_dir: Path, title: str) -> Path | None:
+    async def download(self, msg: Message, dst_dir: Path, title: str, job: Job) -> Path | None:
         """Download a video message with specified title."""
-        if not dst_dir.exists():
-            dst_dir.mkdir(parents=True, exist_ok=True)
-        elif dst_dir.is_file():
+        if not await fs.exists(dst_dir):
+            await fs.mkdir(dst_dir)
+        elif await fs.is_file(dst_dir):
             error_msg = f'{dst_dir} is a file'
             raise ValueError(error_msg)
         
         display_title = f'{sanitize(title, max_bytes=50)} [{msg.id}]'
-        with tqdm(total=0, unit='B', unit_scale=True, desc=display_title, dynamic_ncols=True) as pbar:
-            tmp_path = self.cache_dir / f'{msg.id}'
-
-            def _cb(current: int, total: int) -> None:
-                pbar.total = total
-                pbar.update(current - pbar.n)
-
-            downloaded_path = await msg.download_media(file=str(tmp_path), progress_callback=_cb)
-        if downloaded_path:
-            downloaded_path = Path(downloaded_path)
-            filename = format_video_filename(
-                title=title,
-                video_id=str(msg.id),
-                uploader=None,
-                ext=downloaded_path.suffix,
-            )
-            dst_path = dst_dir / filename
-            shutil.move(downloaded_path, dst_path)
-            return dst_path
-        return None
+        size = msg.file.size if msg.file else 0
+        state = await self.journal.aload(msg.id)
+        if 'moved' in state and await fs.size(Path(state['moved'])) == size:
+            # an earlier attempt got the file into the library but failed to commit it
+            return Path(state['moved'])
+        scratch_factor = 2 if config.faststart else 1
+        with trace.span('admission', size=size):
+            reservation = await admission.reserve({self.journal.root: size * scratch_factor, dst_dir: size}, display_title)
+        try:
+            tracker = progress.track('telegram', msg.id, display_title)
+            try:
+                with trace.span('fetch', size=size):
+                    downloaded_path = await self.download_resumable(msg, tracker)
+            finally:
+                tracker.close()
+            if downloaded_path:
+                get_queue().set_state(job, State.MERGING)
+                filename = format_video_filename(
+                    title=title,
+                    video_id=str(msg.id),
+                    uploader=None,
+                    ext=downloaded_path.suffix,
+                )
+                dst_path = dst_dir / filename
+                with trace.span('faststart'):
+                    await ensure_faststart(downloaded_path)
+                with trace.span('move'):
+                    await fs.move(downloaded_path, dst_path)
+                # the journal is finished once the commit is through, a retry picks the file up from here
+                await self.journal.asave(msg.id, {'moved': str(dst_path)})
+                return dst_path
+            return None
+        finally:
+            await reservation.release()
+
+    async def download_resumable(self, msg: Message, tracker: progress.Tracker) -> Path | None:
+        """Download the media of a message into its journal scratch dir, resuming from the saved offset."""
+        if not msg.file:
+            return None
+        total = msg.file.size
+        scratch = await self.journal.ascratch(msg.id)
+        part_path = scratch / f'{msg.id}{msg.file.ext or ".mp4"}.part'
+        downloaded_path = part_path.with_suffix('')
+        if await fs.size(downloaded_path) == total:
+            return downloaded_path
+        state = await self.journal.aload(msg.id)
+        offset = min(state.get('offset', 0), await fs.size(part_path))
+        offset -= offset % CHUNK_SIZE
+        if offset:
+            log.info('Resuming message %s at %d/%d bytes', msg.id, offset, total)
+        tracker.set(offset, total)
+        f = await fs.run(_open_at, part_path, offset)
+        try:
+            async for chunk in self.client.iter_download(msg.media, offset=offset, request_size=CHUNK_SIZE, file_size=total):
+                # a write can block for long on a slow disk, keep it off the event loop
+                await fs.run(f.write, chunk)
+                offset += len(chunk)
+                tracker.set(offset)
+                if offset % SAVE_EVERY == 0:
+                    await fs.run(f.flush)
+                    await self.journal.asave(msg.id, {'offset': offset})
+        finally:
+            await fs.run(f.close)
+        if offset < total:
+            log.error('Download of message %s stopped at %d/%d bytes', msg.id, offset, total)
+            await self.journal.asave(msg.id, {'offset': offset})
+            return None
+        await fs.replace(part_path, downloaded_path)
+        return downloaded_path
 
     async def update_channel(self, channel_id: int) -> None:
-        channel = await self.client.get_entity(PeerChannel(channel_id))
-        ch_name = getattr(channel, 'username', None) or getattr(channel, 'title', str(channel_id)) or str(channel_id)
-        ch_name = sanitize(ch_name)
-        dst = cfg.path / ch_name
-        dst.mkdir(parents=True, exist_ok=True)
-
-        video_list = await self.get_videos(channel)
-        downloaded_ids = await self.get_downloaded_ids(channel_id)
+        with trace.lane('telegram', f'channel {channel_id}'):
+            with trace.span('entity'):
+                channel = await self.client.get_entity(PeerChannel(channel_id))
+            ch_name = getattr(channel, 'username', None) or getattr(channel, 'title', str(channel_id)) or str(channel_id)
+            ch_name = sanitize(ch_name)
+            dst = cfg.path / ch_name
+            await fs.mkdir(dst)
+
+            with trace.span('scan'):
+                video_list = await self.get_videos(channel)
+            with trace.span('d1'):
+                downloaded_ids = await self.get_downloaded_ids(channel_id)
         
         # Filter out already downloaded videos
         undownloaded = [v for v in video_list if v['msg'].id not in downloaded_ids]
-        
+
         if not undownloaded:
-            log.info('No new videos')
+            log.info('No new videos in %s', ch_name)
             return
-        
-        total_videos = len(undownloaded)
-        
-        for idx, video_data in enumerate(undownloaded, start=1):
-            msg = video_data['msg']
-            filename = video_data['filename']
-            
-            log.info('Downloading videos from %s (%d/%d)', ch_name, idx, total_videos)
-            
-            result = await self.download(msg, dst, filename)
-            if result:
+
+        log.info('Found %d new videos in %s', len(undownloaded), ch_name)
+        for v in undownloaded:
+            self.messages[v['msg'].id] = v['msg']
+        payload = {'channel_id': channel_id, 'channel_name': ch_name}
+        get_queue().put_many('telegram', [(v['msg'].id, {**payload, 'filename': v['filename']}, 0) for v in undownloaded])
+
+    async def download_job(self, job: Job) -> None:
+        """Download and record one queued video message."""
+        msg_id = int(job.key)
+        channel_id = job.payload['channel_id']
+        ch_name = job.payload['channel_name']
+        filename = job.payload['filename']
+        if not await self.leases.claim(msg_id):
+            get_queue().drop(job)
+            return
+        try:
+            with trace.lane('telegram', msg_id):
+                msg = self.messages.get(msg_id) or await self.client.get_messages(PeerChannel(channel_id), ids=msg_id)
+                if msg is None:
+                    log.warning('Message %s in %s no longer exists', msg_id, ch_name)
+                    get_queue().drop(job)
+                    return
+                log.info('Downloading message %s from %s', msg_id, ch_name)
+                result = await self.download(msg, cfg.path / ch_name, filename, job)
+                if not result:
+                    error_msg = f'Failed to download message {msg_id}'
+                    raise ValueError(error_msg)
                 log.notice('Saved %s', result.name)
-                await cloudflare.query_d1(
-                    'INSERT INTO telegram (message_id, channel_id, title, channel_name) VALUES (?, ?, ?, ?);',
-                    (str(msg.id), str(channel_id), filename, ch_name),
-                )
-            else:
-                log.error('Failed to download message %s', msg.id)
+                get_queue().set_state(job, State.COMMITTING)
+                with trace.span('commit'):
+                    await cloudflare.query_d1(
+                        # idempotent, so a 5xx after the download is retried instead of losing the record
+                        'INSERT INTO telegram (message_id, channel_id, title, channel_name) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (message_id) DO NOTHING;',
+                        (str(msg_id), str(channel_id), filename, ch_name),
+                    )
+                await self.journal.afinish(msg_id)
+                await notifier.added(result, source='telegram', video_id=msg_id, title=filename, uploader=ch_name)
+                get_queue().done(job)
+        finally:
+            await self.leases.release(msg_id)
 
-    async def update(self) -> None:
+    async def update(self, channels: list[int] | None = None) -> None:
         # Initialize table
         await cloudflare.query_d1("""
             CREATE TABLE IF NOT EXISTS telegram (
@@ -190,9 +282,14 @@ class Telegram:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
         """)
+        await self.leases.init()
         log.debug('telegram table initialized')
         
         await self.client.start()
-        for channel_id in cfg.channels:
-            await self.update_channel(channel_id)
+        try:
+            for channel_id in channels or cfg.channels:
+                await self.update_channel(channel_id)
+            await run_workers('telegram', self.download_job, cfg.workers, only={'channel_id': channels} if channels else None)
+        finally:
+            await self.leases.close()
         await self.client.disconnect()